@@ -0,0 +1,143 @@
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import telebot
+
+import fake_vk
+
+
+def parse_mix(text):
+    """Parses "photo=0.3,album=0.1,..." into {"photo": 0.3, "album": 0.1, ...}"""
+    mix = {}
+    for pair in filter(None, text.split(",")):
+        kind, share = pair.split("=")
+        mix[kind.strip()] = float(share)
+    return mix
+
+
+def get_peak_rss():
+    """Peak resident memory of the process in MB, None where resource is not available (Windows)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / 1024 / 1024 if sys.platform == "darwin" else peak_rss / 1024
+
+
+def run_benchmark(args):
+    """Runs the bot against FakeVk and FakeTelegram
+
+    Every source gets args.posts posts before the first cycle and again
+    before every next one, all of them must be sent in that cycle
+
+    Returns:
+        dict: Results for print_report()
+    """
+    fake_vk_api = fake_vk.FakeVk(latency=args.vk_latency, document_size=args.document_size)
+    fake_telegram = fake_vk.FakeTelegram(latency=args.tg_latency)
+    fake_vk.start_fake_server(fake_vk_api)
+    fake_vk.start_fake_server(fake_telegram)
+
+    working_dir = tempfile.mkdtemp(prefix="vk-bot-benchmark-")
+    os.environ["VK_BOT_WORKING_DIR"] = working_dir  # config.Dummy creates its json file there
+    import config
+
+    config.vk_api_url = fake_vk_api.base_url + "/method/"
+    config.tg_bot_token = "123456:benchmark"
+    config.tg_log_channel = ""
+    config.metrics_port = 0
+    config.catch_up_max_posts = max(config.catch_up_max_posts, args.posts)
+    if not args.keep_rate_limits:  # measure the bot, not the limits of the real APIs
+        config.vk_requests_per_second = 10 ** 6
+        config.tg_messages_per_second = 10 ** 6
+        config.tg_messages_per_minute_per_chat = 10 ** 8
+        config.tg_chat_burst = 10 ** 6
+    telebot.apihelper.API_URL = fake_telegram.base_url + "/bot{0}/{1}"
+
+    import parcing_bot  # reads the settings above when it is imported
+
+    parcing_bot.logger.addHandler(logging.NullHandler())
+    parcing_bot.logger.propagate = False
+    parcing_bot.prepare_temp_folder()
+    if args.trace:
+        parcing_bot.tracing.configure(args.trace)
+
+    config.list_of_languages.clear()
+    languages = []
+    for number in range(args.sources):
+        x = config.Language(f"bench{number}", f"bench{number}", f"@bench_channel_{number}", [], [])
+        x.req_count = min(args.posts, 100)
+        languages.append(x)
+
+    parcing_bot.start_pipeline()
+    executor = ThreadPoolExecutor(max_workers=parcing_bot.MAX_WORKERS, thread_name_prefix="source")
+    cycle_times = []
+    try:
+        for cycle in range(args.cycles):
+            for number, x in enumerate(languages):
+                fake_vk_api.add_posts(
+                    x.vk_domain,
+                    fake_vk.make_feed(
+                        number + 1, cycle * args.posts + 1, args.posts, args.mix,
+                        fake_vk_api.base_url, args.document_size, args.seed,
+                    ),
+                )
+            cycle_started = time.monotonic()
+            parcing_bot.run_cycle(executor, catch_up=True)
+            cycle_times.append(time.monotonic() - cycle_started)
+    finally:
+        executor.shutdown(wait=True)
+        shutil.rmtree(working_dir, ignore_errors=True)
+
+    posts = sum(parcing_bot.metrics.posts_delivered.get(source=x.vk_domain) for x in languages)
+    return {
+        "sources": args.sources,
+        "posts": posts,
+        "expected_posts": args.sources * args.posts * args.cycles,
+        "total_seconds": sum(cycle_times),
+        "cycle_seconds": cycle_times,
+        "peak_rss_mb": get_peak_rss(),
+        "vk_calls": dict(fake_vk_api.calls),
+        "telegram_calls": dict(fake_telegram.calls),
+        "uploaded_bytes": fake_telegram.uploaded_bytes,
+    }
+
+
+def print_report(results):
+    posts = results["posts"] or 1
+    vk_calls = sum(count for method, count in results["vk_calls"].items() if method not in ("file", "photo"))
+    telegram_calls = sum(results["telegram_calls"].values())
+    print(f"posts sent:        {results['posts']} of {results['expected_posts']}")
+    print(f"posts/s:           {results['posts'] / max(results['total_seconds'], 1e-9):.1f}")
+    print(f"cycle time, s:     {', '.join(f'{seconds:.2f}' for seconds in results['cycle_seconds'])}")
+    if results["peak_rss_mb"] is not None:
+        print(f"peak RSS, MB:      {results['peak_rss_mb']:.1f} (includes the fake servers)")
+    print(f"VK calls/post:     {vk_calls / posts:.2f}  {results['vk_calls']}")
+    print(f"Telegram calls/post: {telegram_calls / posts:.2f}  {results['telegram_calls']}")
+    print(f"uploaded KB/post:  {results['uploaded_bytes'] / posts / 1024:.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures the bot against local fake VK and Telegram servers")
+    parser.add_argument("--sources", type=int, default=10, help="VK communities (each sends to its own channel)")
+    parser.add_argument("--posts", type=int, default=20, help="new posts per source and cycle")
+    parser.add_argument("--cycles", type=int, default=1)
+    parser.add_argument(
+        "--mix", type=parse_mix, default=parse_mix("photo=0.3,album=0.15,doc=0.1,video=0.15,link=0.05,repost=0.1"),
+        help="share of posts with each attachment kind, the rest are text posts",
+    )
+    parser.add_argument("--document-size", type=int, default=100000, help="bytes in every document")
+    parser.add_argument("--vk-latency", type=float, default=0.05, help="seconds before every VK answer")
+    parser.add_argument("--tg-latency", type=float, default=0.05, help="seconds before every Telegram answer")
+    parser.add_argument("--keep-rate-limits", action="store_true", help="keep VK and Telegram pacing from config")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace", metavar="FILE", help="write spans of every post, see tracing.py")
+    print_report(run_benchmark(parser.parse_args()))
+    os._exit(0)  # pipeline and server threads never stop on their own
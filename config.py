@@ -1,9 +1,15 @@
 import os
+import re
 from pathlib import Path
 
-working_dir = ""
+working_dir = os.environ.get("VK_BOT_WORKING_DIR", "")  # jsons/, logs/ and temp/ go here, empty - folder of this file
 current_folder = str(Path(__file__).parent.absolute())
 maximum_ids_per_json = 100
+state_backend = "json"  # "json" (jsons/<lang>.json) or "sqlite" (safe for several bot processes)
+state_sqlite_file = "jsons/state.sqlite3"  # import old jsons with: python storage.py
+sent_ids_retention = maximum_ids_per_json  # sent post ids kept per language, 0 keeps all
+catch_up_max_posts = 100  # newest missed posts sent after downtime, older ones are skipped
+vk_execute_batch_size = 25  # walls requested with one VK "execute" call, 1 turns batching off
 
 if working_dir == "":
     working_dir = current_folder
@@ -13,8 +19,92 @@ tg_bot_token = "#####################"
 tg_bot_for_log_token = ""
 tg_log_channel = "#####################"
 logfile = "logs.log"
+log_level = "INFO"  # lines below it are not formatted, written or sent to tg_log_channel
+log_format = "json"  # "json" (one record per line) or "text"
 single_start = False
-time_to_sleep = 60 * 10
+time_to_sleep = 60 * 10  # seconds between checks of a source when adaptive_polling is off
+adaptive_polling = True  # check busy sources more often and quiet ones less often
+poll_interval_min = 60  # seconds, the most often a source is checked
+poll_interval_max = 60 * 60  # seconds, the least often a source is checked
+poll_interval_factor = 0.25  # a source is checked this many times its usual time between posts
+poll_interval_jitter = 0.1  # intervals are randomly changed by up to 10%, so sources don't line up
+poll_batch_window = 10  # seconds, sources due this soon are checked together (fewer VK "execute" calls)
+poll_budget_per_hour = 1000  # source checks per hour for all sources, intervals are stretched to stay under it
+poll_history_size = 20  # dates of the latest posts kept per source to tell how often it posts
+callback_server_host = "0.0.0.0"  # VK Callback API server, used by languages with input_mode="callback"
+callback_server_port = 8080
+long_poll_wait = 25  # seconds VK holds a Bots Long Poll request open, used by languages with input_mode="longpoll"
+long_poll_error_delay = 5  # seconds to wait before reconnecting after a Long Poll error
+metrics_host = "127.0.0.1"  # address of the /metrics endpoint for Prometheus
+metrics_port = 9108  # 0 turns the /metrics endpoint off
+trace_file = ""  # e.g. "logs/trace.jsonl", timed spans of every post, see "python tracing.py --help"
+max_workers = 8  # how many sources are checked at the same time
+parse_workers = 4  # posts parsed at the same time (VK lookups)
+download_workers = 4  # posts whose documents are downloaded at the same time
+send_workers = 4  # posts sent at the same time (always in order within one channel)
+pipeline_queue_size = 50  # posts waiting in front of every stage
+log_batch_interval = 5  # seconds between log batches sent to tg_log_channel
+log_queue_size = 1000  # log lines waiting to be sent, extra lines are dropped
+log_max_batches = 5  # log messages sent per interval, the rest is summarized
+admin_status_ttl = 60 * 5  # seconds to remember if the bot is a channel admin
+tg_messages_per_second = 30  # per bot, for all chats together
+tg_messages_per_minute_per_chat = 20  # per bot and chat (channel limit)
+tg_chat_burst = 3  # messages sent to one chat at once before the per chat limit applies
+tg_flood_retries = 5  # resends after "429 Too Many Requests" before giving up
+send_max_attempts = 4  # tries for every message when Telegram can't be reached
+send_backoff_base = 2  # seconds, the wait before each next try is doubled
+send_backoff_max = 60  # seconds, longest wait between two tries
+post_send_deadline = 60 * 3  # seconds, after this the post goes to the retry queue
+retry_queue_max_attempts = 5  # cycles a deferred post is tried again before it is given up
+vk_api_url = "https://api.vk.com/method/"
+http_connect_timeout = 5  # seconds
+http_read_timeout = 30  # seconds
+http_pool_connections = 10  # how many hosts keep their connections open
+http_pool_maxsize = 16  # open connections per host
+vk_requests_per_second = 3  # per token, VK can deactivate tokens that make requests too often
+group_name_ttl = 60 * 60 * 24  # seconds to remember community names for reposts
+persist_group_names = True  # keep community names in jsons/group_names.json between restarts
+file_id_cache_size = 10000  # Telegram file_ids of uploaded media kept in jsons/file_ids.json, 0 to turn off
+media_upload_wait = 30  # seconds a channel waits for another one uploading the same media before uploading it too
+max_document_size = 50000000  # bytes, Telegram bots can't send bigger files
+download_chunk_size = 1024 * 256  # bytes read from the network at once
+download_attempts = 3  # interrupted downloads are resumed from the partial file
+doc_download_workers = 3  # documents of one post downloaded at the same time
+photo_url_passthrough = True  # let Telegram download album photos by URL, download them here only if it fails
+photo_download_workers = 5  # album photos downloaded at the same time
+temp_disk_quota = 1024 * 1024 * 1024  # bytes, documents of all posts being processed together
+temp_disk_quota_wait = 60  # seconds to wait for free space before a document is skipped
+
+
+def compile_keywords(keywords):
+    """Compiles a blacklist or whitelist into one case-insensitive regex,
+    so a post text is checked against all words in a single pass.
+
+    Every entry is a substring to look for, except:
+        "word:<word>" - matches only a whole word ("word:ad" does not match "bad")
+        "re:<pattern>" - a regular expression
+
+    Args:
+        keywords (list or string): Words from the list, a non-empty string is one word
+
+    Returns:
+        re.Pattern or None if there are no words
+    """
+    if isinstance(keywords, str):
+        keywords = [keywords] if keywords else []
+    patterns = []
+    for keyword in keywords:
+        if not keyword:
+            continue
+        if keyword.startswith("re:"):
+            patterns.append(f"(?:{keyword[len('re:'):]})")
+        elif keyword.startswith("word:"):
+            patterns.append(rf"(?<!\w){re.escape(keyword[len('word:'):])}(?!\w)")
+        else:
+            patterns.append(re.escape(keyword))
+    if not patterns:
+        return None
+    return re.compile("|".join(patterns), re.IGNORECASE)
 
 
 class Language:
@@ -29,14 +119,31 @@ class Language:
     _is_pinned_post = False
     vk_domain = ""
     tg_channel = ""
+    tg_channels = []
+    input_mode = "poll"  # "poll" - wall.get every cycle, "callback" - VK Callback API pushes new posts,
+    # "longpoll" - new posts are received with Bots Long Poll API
+    group_id = None  # community id, needed for "callback" and "longpoll"
+    group_token = ""  # community access token with Long Poll API enabled, needed for "longpoll"
+    callback_secret = ""  # "Secret key" from the Callback API settings of the community
+    callback_confirmation = ""  # string the server must return to confirm its address
 
-    def __init__(self, lang="language (short), e.g. en / de / ...", at_vk="vk domain", at_tg="tg chat id or domain",
-                 blacklist="list of words to ignore posts", whitelist="leave empty"):
+    def __init__(self, lang="language (short), e.g. en / de / ...", at_vk="vk domain",
+                 at_tg="tg chat id or domain, or a list of them to send every post to several channels",
+                 blacklist="list of words to ignore posts", whitelist="leave empty",
+                 input_mode="poll", group_id=None, callback_secret="", callback_confirmation="", group_token=""):
         self.name = lang
         self.vk_domain = at_vk
-        self.tg_channel = at_tg
+        self.tg_channels = list(at_tg) if isinstance(at_tg, (list, tuple)) else [at_tg]
+        self.tg_channel = self.tg_channels[0]  # first channel, used where only one chat makes sense
         self.BLACKLIST = blacklist
         self.WHITELIST = whitelist
+        self.blacklist_filter = compile_keywords(blacklist)
+        self.whitelist_filter = compile_keywords(whitelist)
+        self.input_mode = input_mode
+        self.group_id = abs(int(group_id)) if group_id else None
+        self.callback_secret = callback_secret
+        self.callback_confirmation = callback_confirmation
+        self.group_token = group_token
         self.jsonfile = lang + ".json"
 
         if not os.path.exists(working_dir + '/jsons/' + self.jsonfile):
@@ -0,0 +1,293 @@
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from collections import Counter
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+
+def make_wall_post(post_id, group_id, text="", attachments=None):
+    """Builds a community wall post the way VK puts it into API responses and events
+
+    Args:
+        post_id (int): Post id
+        group_id (int): Community id (positive)
+        text (string): Post text
+        attachments (list): VK attachments of the post
+
+    Returns:
+        dict
+    """
+    return {
+        "id": post_id,
+        "owner_id": -abs(group_id),
+        "from_id": -abs(group_id),
+        "date": int(time.time()),
+        "post_type": "post",
+        "marked_as_ads": 0,
+        "text": text,
+        "attachments": attachments or [],
+    }
+
+
+def send_callback_event(url, event_type, group_id, secret="", event_object=None):
+    """Sends one event to a Callback API server like VK does
+
+    Args:
+        url (string): Address of the server
+        event_type (string): "confirmation", "wall_post_new", ...
+        group_id (int): Community id (positive)
+        secret (string): Secret key of the community, not sent if empty
+        event_object (dict): Event data, e.g. from make_wall_post()
+
+    Returns:
+        tuple: HTTP status and text of the answer
+    """
+    event = {"type": event_type, "group_id": abs(group_id), "event_id": f"{time.time_ns():x}", "v": "5.131"}
+    if event_object is not None:
+        event["object"] = event_object
+    if secret:
+        event["secret"] = secret
+    response = requests.post(url, json=event, timeout=10)
+    return response.status_code, response.text
+
+
+class FakeApi:
+    """Base of the fake servers: counts calls and waits `latency` seconds before every answer"""
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.base_url = ""
+
+    def count(self, name):
+        with self.lock:
+            self.calls[name] += 1
+
+    def handle(self, http_method, path, params, body):
+        """Returns HTTP status, answer (dict, list or bytes)"""
+        raise NotImplementedError
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    """Passes every request to the FakeApi of the server"""
+
+    def do_GET(self):
+        self.answer("GET")
+
+    def do_POST(self):
+        self.answer("POST")
+
+    def answer(self, http_method):
+        url = urlparse(self.path)
+        params = {name: values[0] for name, values in parse_qs(url.query).items()}
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        fake = self.server.fake
+        if fake.latency:
+            time.sleep(fake.latency)
+        status, answer = fake.handle(http_method, url.path, params, body)
+        if isinstance(answer, bytes):
+            content_type = "application/octet-stream"
+        else:
+            content_type = "application/json"
+            answer = json.dumps(answer).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(answer)))
+        self.end_headers()
+        self.wfile.write(answer)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_server(fake):
+    """Serves a FakeApi on a free local port in a background thread
+
+    Returns:
+        ThreadingHTTPServer, fake.base_url is set to its address
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeApiHandler)
+    server.daemon_threads = True
+    server.fake = fake
+    fake.base_url = f"http://127.0.0.1:{server.server_port}"
+    threading.Thread(target=server.serve_forever, name=type(fake).__name__, daemon=True).start()
+    return server
+
+
+class FakeVk(FakeApi):
+    """Stand-in for api.vk.com and VK file hosting.
+    Answers wall.get, execute (with API.wall.get calls only), video.get and groups.getById,
+    serves documents from /files/ and photos from /photos/
+
+    Args:
+        latency (float): Seconds to wait before every answer
+        document_size (int): Bytes in every served document
+    """
+
+    def __init__(self, latency=0, document_size=100000):
+        super().__init__(latency)
+        self.document_size = document_size
+        self.walls = {}
+
+    def add_posts(self, domain, posts):
+        """Publishes posts on the wall, newest first like wall.get returns them"""
+        with self.lock:
+            self.walls[domain] = sorted(posts + self.walls.get(domain, []), key=lambda post: -post["id"])
+
+    def get_wall(self, params):
+        wall = self.walls.get(params.get("domain"), [])
+        offset = int(params.get("offset", 0))
+        count = int(params.get("count", 20))
+        return {"count": len(wall), "items": wall[offset : offset + count]}
+
+    def handle(self, http_method, path, params, body):
+        if path.startswith("/files/"):
+            self.count("file")
+            return 200, b"x" * self.document_size
+        if path.startswith("/photos/"):
+            self.count("photo")
+            return 200, b"\xff\xd8" + b"x" * 20000
+        method = path[len("/method/"):]
+        self.count(method)
+        if method == "wall.get":
+            return 200, {"response": self.get_wall(params)}
+        if method == "execute":
+            calls = re.findall(r"API\.wall\.get\((\{[^{}]*\})\)", params.get("code", ""))
+            return 200, {"response": [self.get_wall(json.loads(call)) for call in calls]}
+        if method == "video.get":
+            items = []
+            for video in params.get("videos", "").split(","):
+                owner_id, video_id = video.split("_")[:2]
+                items.append({
+                    "owner_id": int(owner_id),
+                    "id": int(video_id),
+                    "files": {"external": f"https://www.youtube.com/watch?v={owner_id}{video_id}"},
+                })
+            return 200, {"response": {"count": len(items), "items": items}}
+        if method == "groups.getById":
+            group_ids = [int(group_id) for group_id in params.get("group_ids", "").split(",") if group_id]
+            return 200, {"response": [{"id": group_id, "name": f"Community {group_id}"} for group_id in group_ids]}
+        return 200, {"error": {"error_code": 3, "error_msg": f"Unknown method passed: {method}"}}
+
+
+class FakeTelegram(FakeApi):
+    """Stand-in for the Telegram Bot API, use with
+    telebot.apihelper.API_URL = fake.base_url + "/bot{0}/{1}"
+
+    Every uploaded or sent media gets a new file_id
+    """
+
+    def __init__(self, latency=0):
+        super().__init__(latency)
+        self.message_ids = 0
+        self.uploaded_bytes = 0
+
+    def create_message(self, chat_id, kind=None):
+        with self.lock:
+            self.message_ids += 1
+            message_id = self.message_ids
+        message = {"message_id": message_id, "date": int(time.time()), "chat": {"id": -1000, "type": "channel"}}
+        file = {"file_id": f"{kind}{message_id}", "file_unique_id": f"u{message_id}"}
+        if kind == "photo":
+            message["photo"] = [dict(file, width=1280, height=720)]
+        elif kind == "document":
+            message["document"] = file
+        return message
+
+    def handle(self, http_method, path, params, body):
+        method = path.rsplit("/", 1)[-1]
+        self.count(method)
+        with self.lock:
+            self.uploaded_bytes += len(body)
+        chat_id = params.get("chat_id")
+        if method == "getChatAdministrators":
+            result = [{"user": {"id": 1, "is_bot": True, "first_name": "bot"}, "status": "creator", "is_anonymous": False}]
+        elif method == "sendPhoto":
+            result = self.create_message(chat_id, "photo")
+        elif method == "sendDocument":
+            result = self.create_message(chat_id, "document")
+        elif method == "sendMediaGroup":
+            result = [self.create_message(chat_id, "photo") for _ in json.loads(params.get("media", "[]"))]
+        else:
+            result = self.create_message(chat_id)
+        return 200, {"ok": True, "result": result}
+
+
+def make_feed(group_id, first_post_id, posts, attachment_mix, files_url, document_size=100000, seed=0):
+    """Generates posts for a fake wall
+
+    Args:
+        group_id (int): Community id (positive)
+        first_post_id (int): Id of the oldest generated post
+        posts (int): How many posts
+        attachment_mix (dict): Share of posts with "photo", "album", "doc", "video", "link"
+            and "repost", the rest are text posts
+        files_url (string): FakeVk.base_url, documents and photos are served from there
+        document_size (int): FakeVk.document_size
+        seed (int): Same seed gives the same posts
+
+    Returns:
+        list: Posts, newest first
+    """
+    rng = random.Random(seed * 1000003 + group_id)
+    now = int(time.time())
+    feed = []
+    for post_id in range(first_post_id, first_post_id + posts):
+        post = make_wall_post(post_id, group_id, f"Post {post_id} of community {group_id}. " + "Text " * rng.randint(5, 80))
+        post["date"] = now - (first_post_id + posts - post_id) * 600
+        roll = rng.random()
+        for kind, share in attachment_mix.items():
+            if roll < share:
+                break
+            roll -= share
+        else:
+            kind = "text"
+
+        def photo(number):
+            url = f"{files_url}/photos/{group_id}_{post_id}_{number}.jpg"
+            return {"type": "photo", "photo": {"sizes": [{"type": "x", "width": 1280, "height": 720, "url": url}]}}
+
+        if kind == "photo":
+            post["attachments"] = [photo(1)]
+        elif kind == "album":
+            post["attachments"] = [photo(number) for number in range(1, rng.randint(2, 10) + 1)]
+        elif kind == "doc":
+            post["attachments"] = [{"type": "doc", "doc": {
+                "owner_id": -group_id, "id": post_id, "type": 1, "size": document_size, "title": f"file_{post_id}.txt",
+                "url": f"{files_url}/files/{group_id}_{post_id}.txt",
+            }}]
+        elif kind == "video":
+            post["attachments"] = [{"type": "video", "video": {"owner_id": -group_id, "id": post_id, "access_key": "k"}}]
+        elif kind == "link":
+            post["attachments"] = [{"type": "link", "link": {"url": f"https://example.com/{group_id}/{post_id}"}}]
+        elif kind == "repost":
+            reposted_group_id = 100000 + rng.randint(1, 50)
+            post["copy_history"] = [make_wall_post(rng.randint(1, 10 ** 6), reposted_group_id, "Reposted text", [photo(1)])]
+        feed.insert(0, post)
+    return feed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake VK that sends Callback API events to a running bot")
+    parser.add_argument("--url", default="http://127.0.0.1:8080/")
+    parser.add_argument("--group-id", type=int, required=True)
+    parser.add_argument("--secret", default="")
+    parser.add_argument("--post-id", type=int, default=int(time.time()))
+    parser.add_argument("--text", default="Test post from fake VK")
+    args = parser.parse_args()
+
+    print("confirmation:", *send_callback_event(args.url, "confirmation", args.group_id, args.secret))
+    print(
+        "wall_post_new:",
+        *send_callback_event(
+            args.url, "wall_post_new", args.group_id, args.secret,
+            make_wall_post(args.post_id, args.group_id, args.text),
+        ),
+    )
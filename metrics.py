@@ -0,0 +1,185 @@
+import time
+import threading
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+registry = []
+
+
+def format_labels(labels):
+    """Formats label pairs as {name="value",...}, values are escaped as the text format requires"""
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base of all metrics, every metric registers itself and keeps
+    one value per set of labels"""
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.append(self)
+
+    def get_key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            samples = list(self.values.items())
+        for key, value in samples:
+            lines.extend(self.render_sample(key, value))
+        return lines
+
+    def render_sample(self, key, value):
+        return [f"{self.name}{format_labels(key)} {format_value(value)}"]
+
+
+class Counter(Metric):
+    """Value that only goes up, e.g. number of requests"""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(self.get_key(labels), 0)
+
+
+class Gauge(Metric):
+    """Value that is read when /metrics is requested, e.g. queue length"""
+
+    kind = "gauge"
+
+    def set_function(self, function, **labels):
+        with self.lock:
+            self.values[self.get_key(labels)] = function
+
+    def render_sample(self, key, function):
+        try:
+            value = function()
+        except Exception:
+            return []
+        return [f"{self.name}{format_labels(key)} {format_value(value)}"]
+
+
+class Histogram(Metric):
+    """Counts observed values (usually seconds) in buckets, with their sum and count"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = {"buckets": [0] * len(self.buckets), "sum": 0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["buckets"][index] += 1
+                    break
+            state["sum"] += value
+            state["count"] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observes how long the block (or the decorated function) took"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def render_sample(self, key, state):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, state["buckets"]):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{format_labels(key + (('le', format_value(bound)),))} {cumulative}")
+        lines.append(f"{self.name}_sum{format_labels(key)} {format_value(state['sum'])}")
+        lines.append(f"{self.name}_count{format_labels(key)} {state['count']}")
+        return lines
+
+
+def render():
+    """All registered metrics in Prometheus text exposition format"""
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Answers GET /metrics, see start_metrics_server()"""
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        answer = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(answer)))
+        self.end_headers()
+        self.wfile.write(answer)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(host, port):
+    """Serves /metrics in a background thread
+
+    Args:
+        host (string): Address to listen on
+        port (int): Port to listen on
+
+    Returns:
+        ThreadingHTTPServer
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+cycle_seconds = Histogram("vkbot_cycle_seconds", "Time of one run_cycle()")
+fetch_seconds = Histogram("vkbot_fetch_seconds", "Time to get the wall of a source with get_data()", ["source"])
+fetch_errors = Counter("vkbot_fetch_errors_total", "Failed wall checks", ["source"])
+parse_seconds = Histogram("vkbot_parse_seconds", "Time to parse one post with parse_post()", ["source"])
+send_seconds = Histogram("vkbot_send_seconds", "Time spent in a send_* helper", ["helper"])
+vk_request_seconds = Histogram("vkbot_vk_request_seconds", "Time of one VK API call", ["method"])
+vk_requests = Counter("vkbot_vk_requests_total", "VK API calls", ["method", "result"])
+telegram_requests = Counter("vkbot_telegram_requests_total", "Telegram Bot API calls", ["method", "result"])
+downloaded_bytes = Counter("vkbot_downloaded_bytes_total", "Bytes of documents and photos downloaded", ["kind"])
+posts_delivered = Counter("vkbot_posts_delivered_total", "Posts sent to a channel (or given up)", ["source"])
+queue_depth = Gauge("vkbot_queue_depth", "Items waiting in a pipeline queue", ["queue"])
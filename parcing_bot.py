@@ -1,21 +1,52 @@
 import os
 import re
 import sys
+
+
+def check_python_version():
+    """Checks Python version.
+    Will close script if Python version is lower than required.
+    Runs before the other imports, ThreadingHTTPServer can't be imported on older versions
+    """
+    if sys.version_info < (3, 7):
+        print('Required python version for this bot is "3.7+"..\n')
+        exit()
+
+
+check_python_version()
+
 import time
-import urllib
-from urllib.request import urlopen
+import random
+import statistics
 import config
+import metrics
+import storage
+import tracing
 import logging
 import requests
-import eventlet
+from requests.adapters import HTTPAdapter
 import telebot
 from logging.handlers import TimedRotatingFileHandler
+import hmac
 import json
+import queue
+import hashlib
+import shutil
+import tempfile
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 bot = telebot.TeleBot(config.tg_bot_token)  # setting up bot
+logger = logging.getLogger('main-log-writer')  # handlers are added by setup_logging()
+LOG_LEVELS = {"w": logging.WARNING, "i": logging.INFO, "e": logging.ERROR}
 WORKING_DIR = config.working_dir
 LOG_DIR = WORKING_DIR + "/logs"
-MAX_IDS_PER_JSON = config.maximum_ids_per_json
+MAX_WORKERS = max(1, int(config.max_workers))
+GROUP_NAMES_FILE = WORKING_DIR + "/jsons/group_names.json"
+FILE_IDS_FILE = WORKING_DIR + "/jsons/file_ids.json"
+TG_MESSAGE_LIMIT = 4096
 
 if len(str(config.tg_log_channel)) > 5:
     if config.tg_bot_for_log_token != "":
@@ -26,6 +57,64 @@ if len(str(config.tg_log_channel)) > 5:
 else:
     is_bot_for_log = False
 
+log_queue = queue.Queue(maxsize=config.log_queue_size)
+file_log_queue = queue.Queue()
+dropped_log_lines = 0
+dropped_log_lines_lock = threading.Lock()
+stop_log_forwarder = threading.Event()
+stop_long_poll = threading.Event()
+
+http_session = requests.Session()
+http_adapter = HTTPAdapter(
+    pool_connections=config.http_pool_connections,
+    pool_maxsize=config.http_pool_maxsize,
+)
+http_session.mount("https://", http_adapter)
+http_session.mount("http://", http_adapter)
+HTTP_TIMEOUT = (config.http_connect_timeout, config.http_read_timeout)
+
+vk_rate_limit_lock = threading.Lock()
+vk_next_request_at = {}
+
+admin_status_cache = {}
+admin_status_cache_lock = threading.Lock()
+
+telegram_buckets = {}
+telegram_buckets_lock = threading.Lock()
+
+group_names = {}
+group_names_lock = threading.Lock()
+
+state_stores = {}
+state_stores_lock = threading.Lock()
+
+poll_intervals = {}
+next_poll_at = {}
+post_dates = {}
+poll_schedule_lock = threading.Lock()
+
+file_id_cache = storage.FileIdCache(FILE_IDS_FILE, config.file_id_cache_size)
+media_uploads = {}
+media_uploads_lock = threading.Lock()
+
+parse_queue = queue.Queue(maxsize=config.pipeline_queue_size)
+download_queue = queue.Queue(maxsize=config.pipeline_queue_size)
+send_queue = queue.Queue(maxsize=config.pipeline_queue_size)
+channel_sequences = {}
+pending_post_ids = set()
+retry_queue = []
+deliveries_in_pipeline = 0
+pipeline_lock = threading.Lock()
+pipeline_idle = threading.Condition(pipeline_lock)
+metrics.queue_depth.set_function(parse_queue.qsize, queue="parse")
+metrics.queue_depth.set_function(download_queue.qsize, queue="download")
+metrics.queue_depth.set_function(send_queue.qsize, queue="send")
+metrics.queue_depth.set_function(lambda: len(retry_queue), queue="retry")
+metrics.queue_depth.set_function(log_queue.qsize, queue="log")
+
+temp_disk_used = 0
+temp_disk_reserved = {}
+temp_disk_condition = threading.Condition()
 
 
 #
@@ -57,17 +146,247 @@ else:
 #         timeout.cancel()
 
 
+class VkApiError(Exception):
+    """VK answered with an error instead of a response"""
+
+
+def http_get(url, **kwargs):
+    """Every VK API call and media download goes through here, so all of them
+    reuse keep-alive connections from http_session and have a timeout
+
+    Args:
+        url (string): Requested URL
+        **kwargs: Passed to requests.Session.get()
+
+    Returns:
+        requests.Response
+    """
+    kwargs.setdefault("timeout", HTTP_TIMEOUT)
+    return http_session.get(url, **kwargs)
+
+
+def wait_for_vk_rate_limit(vk_token):
+    """Keeps requests made with one token at most config.vk_requests_per_second.
+    Every caller reserves the next free time slot and sleeps until it comes
+
+    Args:
+        vk_token (string): Token of the request that is about to be made
+    """
+    with vk_rate_limit_lock:
+        now = time.monotonic()
+        request_at = max(now, vk_next_request_at.get(vk_token, now))
+        vk_next_request_at[vk_token] = request_at + 1 / config.vk_requests_per_second
+    if request_at > now:
+        with tracing.span("sleep.vk_rate_limit"):
+            time.sleep(request_at - now)
+
+
+class TempDiskQuotaError(Exception):
+    """There was no space for a file within config.temp_disk_quota"""
+
+
+class DocumentTooLargeError(Exception):
+    """Downloaded file is bigger than allowed"""
+
+
+def download_file(url, path, max_bytes=None, reserve=None):
+    """Streams url to path chunk by chunk, so the file is never held in memory.
+    The file is written to path + ".part" first, an interrupted download
+    is resumed from there (up to config.download_attempts times)
+
+    Args:
+        url (string): File URL
+        path (string): Where to save the file
+        max_bytes (int): Download is stopped as soon as the file gets bigger than this
+        reserve (callable): Called with the file size before every chunk is written,
+            returns False if there is no disk space for it (download is stopped with TempDiskQuotaError)
+
+    Returns:
+        int: File size in bytes
+    """
+    part_path = path + ".part"
+    for attempt in range(1, config.download_attempts + 1):
+        downloaded = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {"Range": f"bytes={downloaded}-"} if downloaded else {}
+        try:
+            with http_get(url, stream=True, headers=headers) as response:
+                response.raise_for_status()
+                if response.status_code != 206:  # server sent the whole file
+                    downloaded = 0
+                with open(part_path, "ab" if downloaded else "wb") as file:
+                    for chunk in response.iter_content(config.download_chunk_size):
+                        downloaded += len(chunk)
+                        if max_bytes is not None and downloaded > max_bytes:
+                            raise DocumentTooLargeError(f"{url} is bigger than {max_bytes} bytes")
+                        if reserve is not None and not reserve(downloaded):
+                            raise TempDiskQuotaError(f"no space for {url} after {downloaded} bytes")
+                        file.write(chunk)
+                        metrics.downloaded_bytes.inc(len(chunk), kind="document")
+            os.replace(part_path, path)
+            return downloaded
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout):
+            if attempt == config.download_attempts:
+                raise
+        except Exception:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+
+
+def download_photos(photo_urls):
+    """Downloads photos at the same time (at most config.photo_download_workers)
+
+    Args:
+        photo_urls (list): Photo URL list
+
+    Returns:
+        list: Photo bytes in the same order as photo_urls
+    """
+
+    def download_photo(photo_url):
+        response = http_get(photo_url)
+        response.raise_for_status()
+        metrics.downloaded_bytes.inc(len(response.content), kind="photo")
+        return response.content
+
+    with tracing.span("download.photos", photos=len(photo_urls)):
+        with ThreadPoolExecutor(max_workers=max(1, min(config.photo_download_workers, len(photo_urls)))) as downloader:
+            return list(downloader.map(download_photo, photo_urls))
+
+
+def vk_api(method, x: config.Language, **params):
+    """Calls VK API method with the token and API version of the language
+
+    Args:
+        method (string): VK API method, e.g. wall.get
+        x (config.Language): vk_token and req_version are taken from here
+        **params: Method parameters
+
+    Returns:
+        "response" field of the VK answer
+    """
+    data = vk_api_request(method, x, **params)
+    return data["response"]
+
+
+def vk_api_request(method, x: config.Language, **params):
+    """Same as vk_api(), but returns the whole VK answer
+    (e.g. "execute" puts errors of single calls next to "response")"""
+    params.setdefault("access_token", x.vk_token)
+    params.setdefault("v", x.req_version)
+    wait_for_vk_rate_limit(params["access_token"])
+    try:
+        with metrics.vk_request_seconds.time(method=method), tracing.span("vk." + method):
+            data = http_get(config.vk_api_url + method, params=params).json()
+    except Exception:
+        metrics.vk_requests.inc(method=method, result="network_error")
+        raise
+    metrics.vk_requests.inc(method=method, result="error" if "error" in data else "ok")
+    if "error" in data:
+        raise VkApiError(f"{method}: [{data['error'].get('error_code')}] {data['error'].get('error_msg')}")
+    return data
+
+
+def get_temp_folder(x: config.Language):
+    """Each source gets its own temp folder, so sources checked
+    at the same time don't delete each other's files"""
+    return WORKING_DIR + "/temp/" + x.vk_domain
+
+
 def prepare_temp_folder():
-    if "temp" in os.listdir(WORKING_DIR):
-        for root, dirs, files in os.walk(WORKING_DIR + "/temp"):
-            for file in files:
-                os.remove(os.path.join(root, file))
-    else:
-        os.mkdir(WORKING_DIR + "/temp")
+    """Removes files left in the temp folder after the previous run"""
+    if os.path.exists(WORKING_DIR + "/temp"):
+        shutil.rmtree(WORKING_DIR + "/temp", ignore_errors=True)
+    os.makedirs(WORKING_DIR + "/temp", exist_ok=True)
+
+
+def create_post_workspace(postid, x: config.Language):
+    """Creates an empty folder for the files of one post
+
+    Args:
+        postid (integer): Id of the post
+        x (config.Language): Current language
+
+    Returns:
+        string: Path to the folder
+    """
+    os.makedirs(get_temp_folder(x), exist_ok=True)
+    workspace = tempfile.mkdtemp(prefix=f"{postid}-", dir=get_temp_folder(x))
+    with temp_disk_condition:
+        temp_disk_reserved[workspace] = 0
+    return workspace
+
+
+def get_post_workspace(post):
+    """Returns the folder for the files of the post, it is created on first use
+
+    Args:
+        post (dict): Post from parse_post()
+
+    Returns:
+        string: Path to the folder
+    """
+    with pipeline_lock:
+        if post["workspace"] is None:
+            post["workspace"] = create_post_workspace(post["id"], post["x"])
+        return post["workspace"]
+
+
+def reserve_temp_space(workspace, size):
+    """Reserves disk space for a file in the post folder, so all posts together
+    stay under config.temp_disk_quota. Waits up to config.temp_disk_quota_wait
+    seconds for other posts to free their space
+
+    Args:
+        workspace (string): Post folder from create_post_workspace()
+        size (int): File size in bytes
+
+    Returns:
+        [bool]: False if there is no space for the file
+    """
+    global temp_disk_used
+    if size > config.temp_disk_quota:
+        return False
+    deadline = time.monotonic() + config.temp_disk_quota_wait
+    with temp_disk_condition:
+        while temp_disk_used + size > config.temp_disk_quota:
+            time_left = deadline - time.monotonic()
+            if time_left <= 0:
+                return False
+            with tracing.span("sleep.temp_disk_quota"):
+                temp_disk_condition.wait(time_left)
+        temp_disk_used += size
+        temp_disk_reserved[workspace] += size
+    return True
+
+
+def remove_post_workspace(workspace):
+    """Deletes the post folder with all files and frees its reserved disk space"""
+    global temp_disk_used
+    shutil.rmtree(workspace, ignore_errors=True)
+    with temp_disk_condition:
+        temp_disk_used -= temp_disk_reserved.pop(workspace, 0)
+        temp_disk_condition.notify_all()
+
+
+def get_safe_file_name(file_name):
+    """Removes characters that can't be a part of a file name and makes it short enough"""
+    return re.sub(r'[\\/:*?"<>|\x00-\x1f]', "_", file_name)[-150:].strip(" .") or "file"
+
+
+def get_file_hash(path):
+    """Content hash of a downloaded file, the same file from different URLs gets the same key in file_id_cache"""
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(config.download_chunk_size), b""):
+            file_hash.update(chunk)
+    return "sha256:" + file_hash.hexdigest()
 
 
 def blacklist_check(text, x: config.Language):
     """Checks text or links for forbidden words from config.BLACKLIST
+    (compiled by config.compile_keywords())
 
     Args:
         text (string): message text or link
@@ -76,16 +395,14 @@ def blacklist_check(text, x: config.Language):
     Returns:
         [bool]
     """
-    if x.BLACKLIST:
-        text_lower = text.lower()
-        for black_word in x.BLACKLIST:
-            if black_word.lower() in text_lower:
-                return True
+    if x.blacklist_filter is not None:
+        return x.blacklist_filter.search(text) is not None
     return False
 
 
 def whitelist_check(text, x: config.Language):
     """Checks text or links for filter words from config.WHITELIST
+    (compiled by config.compile_keywords())
 
     Args:
         text (string): message text or link
@@ -94,12 +411,8 @@ def whitelist_check(text, x: config.Language):
     Returns:
         [bool]
     """
-    if x.WHITELIST:
-        text_lower = text.lower()
-        for white_word in x.WHITELIST:
-            if white_word.lower() in text_lower:
-                return False
-        return True
+    if x.whitelist_filter is not None:
+        return x.whitelist_filter.search(text) is None
     return False
 
 
@@ -171,53 +484,179 @@ def compile_links_and_text(postid, text_of_post, links_list, videos_list, x: con
     try:
         add_links(videos_list)
         add_links(links_list)
-        add_log("i", f"[id:{postid}] Link(s) was(were) added to post text", x)
+        add_log("i", "Link(s) was(were) added to post text", x, postid=postid)
     except Exception as ex:
         add_log(
             "e",
-            f"[id:{postid}] [{type(ex).__name__}] in compile_links_and_text(): {str(ex)}",
+            f"[{type(ex).__name__}] in compile_links_and_text(): {str(ex)}",
             x,
+            postid=postid,
         )
     return text_of_post
 
 
-def send_posts(postid, text_of_post, photo_url_list, docs_list, x: config.Language):
+class SendDeferredError(Exception):
+    """Telegram could not be reached before the post deadline, the post should be sent later"""
+
+
+def is_retryable_error(ex: Exception):
+    """Checks if sending again later can help: network problems,
+    Telegram server errors and flood limits. Everything else is fatal
+
+    Args:
+        ex (Exception): Exception raised while sending
+
+    Returns:
+        [bool]
+    """
+    if isinstance(
+        ex,
+        (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+            ConnectionError,
+            TimeoutError,
+        ),
+    ):
+        return True
+    if isinstance(ex, telebot.apihelper.ApiTelegramException):
+        return ex.error_code == 429 or ex.error_code >= 500
+    return False
+
+
+def call_with_retry(function, deadline, postid, x: config.Language):
+    """Calls function until it works, at most config.send_max_attempts times.
+    Waits between attempts grow exponentially (with random jitter) up to
+    config.send_backoff_max seconds
+
+    Args:
+        function: Function without arguments that sends something
+        deadline (float): time.monotonic() after which the post is not retried anymore
+        postid (integer): Id of the post. Used for better logging
+        x (config.Language): Current language
+
+    Returns:
+        Whatever the function returns. Fatal errors are raised as they are,
+        SendDeferredError is raised if retryable errors did not stop in time
+    """
+    for attempt in range(1, config.send_max_attempts + 1):
+        try:
+            return function()
+        except Exception as ex:
+            if not is_retryable_error(ex):
+                raise
+            delay = random.uniform(0, min(config.send_backoff_max, config.send_backoff_base * 2 ** (attempt - 1)))
+            if attempt == config.send_max_attempts or time.monotonic() + delay > deadline:
+                raise SendDeferredError(f"[{type(ex).__name__}] {str(ex)}") from ex
+            add_log(
+                "w",
+                f"[{type(ex).__name__}] {str(ex)}. Bot will try to resend message in {delay:.1f} s",
+                x,
+                postid=postid,
+            )
+            with tracing.span("sleep.send_backoff", attempt=attempt):
+                time.sleep(delay)
+
+
+def send_posts(
+    postid, text_of_post, photo_url_list, docs_list, x: config.Language, progress=None, tg_channel=None, post=None
+):
     """Checks the type of post and sends it to Telegram in a suitable method
 
     Args:
         postid (integer): Id of the post that is sent to Telegram. Used for better logging
         text_of_post (string): Post text with links to videos and other links from post attachments
         photo_url_list (list): Photo URL list
-        docs_list (list): List of urls to docs
+        docs_list (list): List of downloaded docs
         x (config.Language class item)
+        progress (dict): Shared by all parts of one post, see deliver_post().
+            Messages that were already sent before the post was deferred are skipped
+        tg_channel: Target chat, x.tg_channel if not given
+        post (dict): Post from parse_post(), documents whose cached file_id was rejected
+            by Telegram are downloaded into its workspace and uploaded again
+
+    Raises:
+        SendDeferredError: Telegram could not be reached before the post deadline
     """
+    if progress is None:
+        progress = {"index": 0, "done": 0, "deadline": time.monotonic() + config.post_send_deadline}
+    if tg_channel is None:
+        tg_channel = x.tg_channel
+
+    def run_step(function):
+        progress["index"] += 1
+        if progress["index"] <= progress["done"]:
+            return None
+        try:
+            result = call_with_retry(function, progress["deadline"], postid, x)
+        except SendDeferredError:
+            raise
+        except Exception:
+            progress["done"] = progress["index"]  # fatal errors are not sent again
+            raise
+        progress["done"] = progress["index"]
+        return result
+
+    def send(method, *args, **kwargs):
+        return run_step(lambda: telegram_call(bot, method, tg_channel, *args, **kwargs))
+
+    def remember_photos(photo_urls, messages):
+        for photo_url, message in zip(photo_urls, messages):
+            if getattr(message, "photo", None):
+                file_id_cache.put(photo_url, message.photo[-1].file_id)
+
+    def send_photo(photo_url, *args, **kwargs):
+        def send_cached_photo():
+            uploading = not file_id_cache.get(photo_url) and claim_media_upload(photo_url)
+            try:
+                file_id = file_id_cache.get(photo_url)
+                if file_id:
+                    try:
+                        return telegram_call(bot, "send_photo", tg_channel, file_id, *args, **kwargs)
+                    except Exception as ex:
+                        if not is_file_id_rejected_error(ex):
+                            raise
+                        file_id_cache.discard(photo_url)
+                message = telegram_call(bot, "send_photo", tg_channel, photo_url, *args, **kwargs)
+                remember_photos([photo_url], [message])
+                return message
+            finally:
+                if uploading:
+                    release_media_upload(photo_url)
+
+        return run_step(send_cached_photo)
 
     def start_sending():
         try:
             if len(photo_url_list) == 0:
-                add_log("i", f"[id:{postid}] Bot is trying to send text post", x)
+                add_log("i", "Bot is trying to send text post", x, postid=postid)
                 send_text_post()
             elif len(photo_url_list) == 1:
-                add_log("i", f"[id:{postid}] Bot is trying to send post with photo", x)
+                add_log("i", "Bot is trying to send post with photo", x, postid=postid)
                 send_photo_post()
             elif len(photo_url_list) >= 2:
-                add_log("i", f"[id:{postid}] Bot is trying to send post with photos", x)
+                add_log("i", "Bot is trying to send post with photos", x, postid=postid)
                 send_photos_post()
 
             if docs_list:
                 send_docs()
+        except SendDeferredError:
+            raise
         except Exception as ex:
             add_log(
                 "e",
-                f"[id:{postid}] [{type(ex).__name__}] in start_sending(): {str(ex)}",
+                f"[{type(ex).__name__}] in start_sending(): {str(ex)}",
                 x,
+                postid=postid,
             )
 
+    @metrics.send_seconds.time(helper="text")
     def send_text_post():
         try:
             if text_of_post:
                 if len(text_of_post) < 4096:
-                    bot.send_message(x.tg_channel, text_of_post, parse_mode="HTML")
+                    send("send_message", text_of_post, parse_mode="HTML")
                 else:
                     text_parts = split_large_text(text_of_post, 4084)
                     prepared_text_parts = [
@@ -230,148 +669,400 @@ def send_posts(postid, text_of_post, photo_url_list, docs_list, x: config.Langua
                     )
 
                     for part in prepared_text_parts:
-                        bot.send_message(
-                            x.tg_channel, part, parse_mode="HTML"
-                        )
-                        time.sleep(1)
-                add_log("i", f"[id:{postid}] Text post sent", x)
+                        send("send_message", part, parse_mode="HTML")
+                add_log("i", "Text post sent", x, postid=postid)
             else:
-                add_log("i", f"[id:{postid}] Text post skipped because it is empty", x)
+                add_log("i", "Text post skipped because it is empty", x, postid=postid)
+        except SendDeferredError:
+            raise
         except Exception as ex:
-            if type(ex).__name__ == "ConnectionError":
-                add_log(
-                    "w",
-                    f"[id:{postid}] [{type(ex).__name__}] in send_text_post(): {str(ex)}",
-                    x,
-                )
-                add_log("i", f"[id:{postid}] Bot trying to resend message to user", x)
-                time.sleep(3)
-                send_text_post()
+            handle_send_error(bot, tg_channel, ex)
             add_log(
                 "e",
-                f"[id:{postid}] [{type(ex).__name__}] in send_text_post(): {str(ex)}",
+                f"[{type(ex).__name__}] in send_text_post(): {str(ex)}",
                 x,
+                postid=postid,
             )
 
+    @metrics.send_seconds.time(helper="photo")
     def send_photo_post():
         try:
             if len(text_of_post) <= 1024:
-                bot.send_photo(
-                    x.tg_channel,
+                send_photo(
                     photo_url_list[0],
                     text_of_post,
                     parse_mode="HTML",
                 )
-                add_log("i", f"[id:{postid}] Text post (<1024) with photo sent", x)
+                add_log("i", "Text post (<1024) with photo sent", x, postid=postid)
             else:
                 post_with_photo = f'<a href="{photo_url_list[0]}"> </a>{text_of_post}'
                 if len(post_with_photo) <= 4096:
-                    bot.send_message(
-                        x.tg_channel, post_with_photo, parse_mode="HTML"
-                    )
+                    send("send_message", post_with_photo, parse_mode="HTML")
                 else:
                     send_text_post()
-                    bot.send_photo(x.tg_channel, photo_url_list[0])
-                add_log("i", f"[id:{postid}] Text post (>1024) with photo sent", x)
+                    send_photo(photo_url_list[0])
+                add_log("i", "Text post (>1024) with photo sent", x, postid=postid)
+        except SendDeferredError:
+            raise
         except Exception as ex:
+            handle_send_error(bot, tg_channel, ex)
             add_log(
                 "e",
-                f"[id:{postid}] [{type(ex).__name__}] in send_photo_post(): {str(ex)}",
-                x
+                f"[{type(ex).__name__}] in send_photo_post(): {str(ex)}",
+                x,
+                postid=postid,
             )
-            if type(ex).__name__ == "ConnectionError":
-                add_log("i", f"[id:{postid}] Bot trying to resend message to user", x)
-                time.sleep(3)
-                send_photo_post()
 
+    @metrics.send_seconds.time(helper="photos")
     def send_photos_post():
-        try:
-            photo_list = []
-            for url_photo in photo_url_list:
-                photo_list.append(
-                    telebot.types.InputMediaPhoto(urllib.request.urlopen(url_photo).read())
-                )
-
+        def send_album(photos):
+            photo_list = [telebot.types.InputMediaPhoto(photo) for photo in photos]
             if 1024 >= len(text_of_post) > 0:
                 photo_list[0].caption = text_of_post
                 photo_list[0].parse_mode = "HTML"
-            elif len(text_of_post) > 1024:
+            return telegram_call(bot, "send_media_group", tg_channel, photo_list)
+
+        def send_photos():
+            file_ids = [file_id_cache.get(photo_url) for photo_url in photo_url_list]
+            if all(file_ids):
+                try:
+                    return send_album(file_ids)
+                except Exception as ex:
+                    if not is_file_id_rejected_error(ex):
+                        raise
+                    for photo_url in photo_url_list:
+                        file_id_cache.discard(photo_url)
+            messages = None
+            if config.photo_url_passthrough:
+                try:
+                    messages = send_album(photo_url_list)
+                except telebot.apihelper.ApiTelegramException as ex:
+                    if not is_url_rejected_error(ex):
+                        raise
+                    add_log(
+                        "w",
+                        f"Telegram could not get photos by URL ({ex.description}), downloading them",
+                        x,
+                        postid=postid,
+                    )
+            if messages is None:
+                messages = send_album(download_photos(photo_url_list))
+            remember_photos(photo_url_list, messages or [])
+            return messages
+
+        def send_photos_once():
+            album_key = tuple(photo_url_list)
+            uploading = (
+                not all(file_id_cache.get(photo_url) for photo_url in photo_url_list)
+                and claim_media_upload(album_key)
+            )
+            try:
+                return send_photos()
+            finally:
+                if uploading:
+                    release_media_upload(album_key)
+
+        try:
+            if len(text_of_post) > 1024:
                 send_text_post()
-            bot.send_media_group(x.tg_channel, photo_list)
-            add_log("i", f"[id:{postid}] Text post with photos sent", x)
+            run_step(send_photos_once)
+            add_log("i", "Text post with photos sent", x, postid=postid)
+        except SendDeferredError:
+            raise
         except Exception as ex:
+            handle_send_error(bot, tg_channel, ex)
             add_log(
                 "e",
-                f"[id:{postid}] [{type(ex).__name__}] in send_photos_post(): {str(ex)}",
-                x
+                f"[{type(ex).__name__}] in send_photos_post(): {str(ex)}",
+                x,
+                postid=postid,
             )
-            if type(ex).__name__ == "ConnectionError":
-                add_log("i", f"[id:{postid}] Bot trying to resend message to user", x)
-                time.sleep(3)
-                send_photos_post()
 
+    @metrics.send_seconds.time(helper="docs")
     def send_docs():
         def send_doc(document):
-            try:
-                with open(WORKING_DIR + "/temp/" + document['title'], "rb") as file:
-                    bot.send_document(x.tg_channel, file)
+            def get_cached_file_id():
+                return file_id_cache.get(document["key"]) or file_id_cache.get(document["hash"])
 
-                add_log("i", f"[id:{postid}] Document [{document['type']}] sent", x)
+            def send_file():
+                uploading = not get_cached_file_id() and claim_media_upload(document["key"])
+                try:
+                    file_id = get_cached_file_id()
+                    if file_id:
+                        try:
+                            return telegram_call(bot, "send_document", tg_channel, file_id)
+                        except Exception as ex:
+                            if not is_file_id_rejected_error(ex):
+                                raise
+                            file_id_cache.discard(document["key"])
+                            file_id_cache.discard(document["hash"])
+                        if not uploading:
+                            uploading = claim_media_upload(document["key"])
+                            if not uploading and get_cached_file_id():  # uploaded again by another channel
+                                return telegram_call(bot, "send_document", tg_channel, get_cached_file_id())
+                    if document["path"] is None:
+                        if post is None:
+                            raise FileNotFoundError(f"document {document['key']} was not downloaded")
+                        add_log(
+                            "w",
+                            "Telegram rejected the cached document [%s], downloading it again",
+                            x,
+                            document["type"],
+                            postid=postid,
+                        )
+                        document["path"] = download_document(
+                            document["url"], document["title"], document["size"], post
+                        )
+                        document["hash"] = get_file_hash(document["path"])
+                    with open(document["path"], "rb") as file:
+                        message = telegram_call(
+                            bot, "send_document", tg_channel, file, visible_file_name=document["title"]
+                        )
+                    file_id_cache.put(document["key"], message.document.file_id)
+                    file_id_cache.put(document["hash"], message.document.file_id)
+                    return message
+                finally:
+                    if uploading:
+                        release_media_upload(document["key"])
+
+            try:
+                run_step(send_file)
+                add_log("i", "Document [%s] sent", x, document["type"], postid=postid)
+            except SendDeferredError:
+                raise
             except Exception as ex:
+                handle_send_error(bot, tg_channel, ex)
                 add_log(
                     "e",
-                    f"[id:{postid}] [{type(ex).__name__}] in send_docs(): {str(ex)}",
+                    f"[{type(ex).__name__}] in send_docs(): {str(ex)}",
                     x,
+                    postid=postid,
                 )
-                if type(ex).__name__ == "ConnectionError":
-                    add_log("i", f"[id:{postid}] Bot trying to resend message to user", x)
-                    time.sleep(3)
-                    send_doc(document)
 
         for document in docs_list:
             send_doc(document)
-            if len(docs_list) > 1:
-                time.sleep(1)
 
     start_sending()
 
 
+def deliver_post(delivery):
+    """Sends all parts of a post (post and repost) to the target channel of the delivery.
+    If Telegram can't be reached before config.post_send_deadline, sending stops
+    and the delivery remembers how many messages were already sent, so the next
+    attempt continues from there
+
+    Args:
+        delivery (dict): Delivery from create_delivery()
+
+    Returns:
+        [bool]: True if the post is done, False if it was deferred
+    """
+    post = delivery["post"]
+    progress = {
+        "index": 0,
+        "done": delivery["sent_messages"],
+        "deadline": time.monotonic() + config.post_send_deadline,
+    }
+    try:
+        with tracing.activate(post["trace"]), tracing.span("deliver_post", channel=delivery["tg_channel"]):
+            for part in post["parts"]:
+                send_posts(
+                    post["id"], part["text"], part["photos"], part["docs"], post["x"], progress, delivery["tg_channel"],
+                    post,
+                )
+    except SendDeferredError as ex:
+        delivery["sent_messages"] = progress["done"]
+        delivery["attempts"] += 1
+        add_log("w", f"Sending to {delivery['tg_channel']} was deferred after {ex}", post["x"], postid=post['id'])
+        return False
+    return True
+
+
+def load_group_names():
+    """Reads community names saved by save_group_names()"""
+    if not config.persist_group_names or not os.path.exists(GROUP_NAMES_FILE):
+        return
+    try:
+        with open(GROUP_NAMES_FILE, "r") as file:
+            saved_names = json.load(file)
+        with group_names_lock:
+            for group_id, (name, fetched_at) in saved_names.items():
+                group_names[int(group_id)] = (name, fetched_at)
+    except Exception as ex:
+        logger.error(f"[{type(ex).__name__}] in load_group_names(): {str(ex)}")
+
+
+def save_group_names():
+    """Writes community names to jsons/group_names.json (through a temp file,
+    so a crash while writing doesn't break the saved names)"""
+    if not config.persist_group_names:
+        return
+    try:
+        with group_names_lock:
+            with open(GROUP_NAMES_FILE + ".tmp", "w") as file:
+                json.dump({str(group_id): list(value) for group_id, value in group_names.items()}, file, ensure_ascii=False)
+            os.replace(GROUP_NAMES_FILE + ".tmp", GROUP_NAMES_FILE)
+    except Exception as ex:
+        logger.error(f"[{type(ex).__name__}] in save_group_names(): {str(ex)}")
+
+
+def get_cached_group_name(group_id):
+    """Returns community name if it is known and not older than config.group_name_ttl"""
+    with group_names_lock:
+        cached = group_names.get(group_id)
+    if cached is not None and time.time() - cached[1] < config.group_name_ttl:
+        return cached[0]
+    return None
+
+
+def prefetch_group_names(group_ids, x: config.Language):
+    """Asks groups.getById for every community that is not cached yet, in one request
+
+    Args:
+        group_ids (iterable): Positive ids of communities
+        x (config.Language): Current language
+    """
+    unknown_ids = sorted({group_id for group_id in group_ids if get_cached_group_name(group_id) is None})
+    if not unknown_ids:
+        return
+    try:
+        data = vk_api("groups.getById", x, group_ids=",".join(map(str, unknown_ids)))
+    except Exception as ex:
+        add_log("e", f"[{type(ex).__name__}] in prefetch_group_names(): {str(ex)}", x)
+        return
+    if isinstance(data, dict):  # newer API versions wrap the list
+        data = data.get("groups", [])
+    fetched_at = time.time()
+    with group_names_lock:
+        for group in data:
+            group_names[group["id"]] = (group["name"], fetched_at)
+    save_group_names()
+
+
+def prefetch_repost_group_names(feed, x: config.Language):
+    """Makes sure names of all reposted communities from the feed are cached"""
+    prefetch_group_names(
+        [abs(post["copy_history"][0]["owner_id"]) for post in feed if post.get("copy_history")], x
+    )
+
+
+def get_public_name_by_id(owner_id, x: config.Language):
+    """Returns community name for the repost header
+
+    Args:
+        owner_id (integer): Positive id of the community
+        x (config.Language): Current language
+
+    Returns:
+        string: Community name or "" if VK did not return it
+    """
+    group_name = get_cached_group_name(owner_id)
+    if group_name is None:
+        prefetch_group_names([owner_id], x)
+        group_name = get_cached_group_name(owner_id)
+    return group_name or ""
+
+
+def get_video_urls(posts, x: config.Language):
+    """Resolves all videos attached to the posts with one video.get request
+
+    Args:
+        posts (list): Posts (and reposts) whose video attachments are resolved
+        x (config.Language): Current language
+
+    Returns:
+        dict: "owner_id_video_id" -> external video URL, videos without one are missing
+    """
+    videos = []
+    for post in posts:
+        for attachment in post.get("attachments", []):
+            if attachment["type"] == "video":
+                video = attachment["video"]
+                video_key = f"{video['owner_id']}_{video['id']}"
+                if "access_key" in video:
+                    video_key += f"_{video['access_key']}"
+                if video_key not in videos:
+                    videos.append(video_key)
+    if not videos:
+        return {}
+
+    try:
+        data = vk_api("video.get", x, videos=",".join(videos), count=len(videos))
+    except Exception as ex:
+        add_log("e", f"[{type(ex).__name__}] in get_video_urls(): {str(ex)}", x)
+        return {}
+    return {
+        f"{video['owner_id']}_{video['id']}": video["files"]["external"]
+        for video in data["items"]
+        if "external" in video.get("files", {})
+    }
+
+
+def create_post(item, x: config.Language):
+    """Creates an empty post that goes through the pipeline stages
+
+    Args:
+        item json file from request: Post received from VK
+        x (config.Language): Current language
+
+    Returns:
+        dict: Post without parts, nothing will be sent for it
+    """
+    return {
+        "id": item["id"],
+        "x": x,
+        "is_pinned": bool(item.get("is_pinned")),
+        "parse_failed": False,
+        "seqs": {},
+        "trace": None,
+        "workspace": None,
+        "file_numbers": itertools.count(1),
+        "parts": [],
+        "deliveries_left": 0,
+    }
+
+
 def parse_post(item, x: config.Language):
     """For each post in the received posts list:
-        * Сhecks post id to make sure it is larger than the one written in the last_known_id.txt
+        * Checks the post with blacklist and whitelist filters
         * Parses all attachments of post or repost
         * Calls 'compile_links_and_text()' to compile links to videos and other links from post to post text
-        * Calls 'send_posts()' to send post to Telegram channel (config.tg_channel)
+
+    Documents are only collected here, download_post() downloads them
 
     Args:
-        item json file from request: List of posts received from VK
-        x: The current value in the last_known_id.txt
-                           (must be less than id of the new post)
+        item json file from request: Post received from VK
+        x (config.Language): Current language
+
+    Returns:
+        dict: Post for download_post() and deliver_post(), its "parts" are sent
+            one by one (post and repost). A post skipped by filters has no parts
     """
+    post = create_post(item, x)
 
     if blacklist_check(item["text"], x):
-        add_log("i", f"[id:{item['id']}] Post was skipped due to blacklist filter", x)
+        add_log("i", "Post was skipped due to blacklist filter", x, postid=item['id'])
     elif whitelist_check(item["text"], x):
-        add_log("i", f"[id:{item['id']}] Post was skipped due to whitelist filter", x)
+        add_log("i", "Post was skipped due to whitelist filter", x, postid=item['id'])
     else:
 
-        if x.skip_ads_posts and item["marked_as_ads"] == 1:
+        if x.skip_ads_posts and item.get("marked_as_ads") == 1:
             add_log(
                 "i",
-                f"[id:{item['id']}] Post was skipped because it was flagged as ad",
+                "Post was skipped because it was flagged as ad",
                 x,
+                postid=item['id'],
             )
             pass
         if x.skip_copyrighted_post and "copyright" in item:
             add_log(
                 "i",
-                f"[id:{item['id']}] Post was skipped because it has copyright",
+                "Post was skipped because it has copyright",
                 x,
+                postid=item['id'],
             )
             pass
-        add_log("i", f"[id:{item['id']}] Bot is working with this post", x)
-
-        prepare_temp_folder()  ############ MAYBE X HERE ???
+        add_log("i", "Bot is working with this post", x, postid=item['id'])
 
         def get_link(attachment):
             try:
@@ -382,43 +1073,24 @@ def parse_post(item, x: config.Language):
             except Exception as ex:
                 add_log(
                     "e",
-                    f'[id:{item["id"]}] [{type(ex).__name__}] in get_link(): {str(ex)}',
+                    f'[{type(ex).__name__}] in get_link(): {str(ex)}',
                     x,
+                    postid=item["id"],
                 )
 
         def get_video(attachment):
-            def get_video_url(owner_id, video_id, access_key):
-                try:
-                    data = requests.get(
-                        "https://api.vk.com/method/video.get",
-                        params={
-                            "access_token": x.vk_token,
-                            "v": x.req_version,
-                            "videos": f"{owner_id}_{video_id}_{access_key}",
-                        },
-                    )
-
-                    return data.json()["response"]["items"][0]["files"]["external"]
-                except Exception:
-                    return None
-
             try:
-                video = get_video_url(
-                    attachment["video"]["owner_id"],
-                    attachment["video"]["id"],
-                    attachment["video"]["access_key"],
+                owner_id = attachment["video"]["owner_id"]
+                video_id = attachment["video"]["id"]
+                return video_urls.get(
+                    f"{owner_id}_{video_id}", f"https://vk.com/video{owner_id}_{video_id}"
                 )
-                # wait for a few seconds because VK can deactivate the access token due to frequent requests
-                time.sleep(2)
-                if video is not None:
-                    return video
-                else:
-                    return f"https://vk.com/video{attachment['video']['owner_id']}_{attachment['video']['id']}"
             except Exception as ex:
                 add_log(
                     "e",
-                    f'[id:{item["id"]}] [{type(ex).__name__}] in get_video(): {str(ex)}',
+                    f'[{type(ex).__name__}] in get_video(): {str(ex)}',
                     x,
+                    postid=item["id"],
                 )
 
         def get_photo(attachment):
@@ -444,57 +1116,12 @@ def parse_post(item, x: config.Language):
             except Exception as ex:
                 add_log(
                     "e",
-                    f'[id:{item["id"]}] [{type(ex).__name__}] in get_photo(): {str(ex)}',
-                    x,
-                )
-
-        def get_doc(document):
-            document_types = {
-                1: "text_document",
-                2: "archive",
-                3: "gif",
-                4: "image",
-                5: "audio",
-                6: "video",
-                7: "ebook",
-                8: "unknown",
-            }
-            document_type = document_types[document["type"]]
-            if document["size"] > 50000000:
-                add_log("i", f"Document [{document['type']}] skipped because it > 50 MB", x)
-                return
-            else:
-                response = requests.get(document["url"])
-
-                with open(WORKING_DIR + "/temp/" + document['title'], "wb") as file:
-                    file.write(response.content)
-
-            return {
-                "type": document_type,
-                "title": document["title"],
-                "url": document["url"],
-            }
-
-        def get_public_name_by_id(owner_id):
-            try:
-                data = requests.get(
-                    "https://api.vk.com/method/groups.getById",
-                    params={
-                        "access_token": x.vk_token,
-                        "v": x.req_version,
-                        "group_id": owner_id,
-                    },
-                )
-                return data.json()["response"][0]["name"]
-            except Exception as ex:
-                add_log(
-                    "e",
-                    f'[id:{item["id"]}] [{type(ex).__name__}] in get_public_name_by_id(): {str(ex)}',
+                    f'[{type(ex).__name__}] in get_photo(): {str(ex)}',
                     x,
+                    postid=item["id"],
                 )
-                return ""
 
-        def parse_attachments(item, links_list, vids_list, photos_list, docs_list):
+        def parse_attachments(item, links_list, vids_list, photos_list, documents):
             
             try:
                 for attachment in item["attachments"]:
@@ -513,26 +1140,26 @@ def parse_post(item, x: config.Language):
                             )
                         )
                     elif attachment["type"] == "doc":
-                        doc_data = get_doc(attachment["doc"])
-                        if doc_data:
-                            docs_list.append(doc_data)
+                        documents.append(attachment["doc"])
             except Exception as ex:
                 add_log(
                     "e",
-                    f'[id:{item["id"]}] [{type(ex).__name__}] in parse_attachments(): {str(ex)}',
+                    f'[{type(ex).__name__}] in parse_attachments(): {str(ex)}',
                     x,
+                    postid=item["id"],
                 )
 
         try:
+            video_urls = get_video_urls([item] + item.get("copy_history", [])[:1], x)
             text_of_post = ready_for_html(item["text"])
             links_list = []
             videos_list = []
             photo_url_list = []
-            docs_list = []
+            documents = []
 
             if "attachments" in item:
                 parse_attachments(
-                    item, links_list, videos_list, photo_url_list, docs_list
+                    item, links_list, videos_list, photo_url_list, documents
                 )
             text_of_post = compile_links_and_text(
                 item["id"],
@@ -544,10 +1171,12 @@ def parse_post(item, x: config.Language):
             )
             if "copy_history" in item and text_of_post != "":
                 group_name = get_public_name_by_id(
-                    abs(item["copy_history"][0]["owner_id"])
+                    abs(item["copy_history"][0]["owner_id"]), x
                 )
                 text_of_post = f"""{text_of_post}\n\nREPOST ↓ {group_name}"""
-            send_posts(item["id"], text_of_post, photo_url_list, docs_list, x)
+            post["parts"].append(
+                {"text": text_of_post, "photos": photo_url_list, "documents": documents, "docs": []}
+            )
 
             if "copy_history" in item:
                 item_repost = item["copy_history"][0]
@@ -558,9 +1187,9 @@ def parse_post(item, x: config.Language):
                 links_list_rep = []
                 videos_list_rep = []
                 photo_url_list_rep = []
-                docs_list_rep = []
+                documents_rep = []
                 group_id = abs(item_repost["owner_id"])
-                group_name = get_public_name_by_id(group_id)
+                group_name = get_public_name_by_id(group_id, x)
 
                 if "attachments" in item_repost:
                     parse_attachments(
@@ -568,7 +1197,7 @@ def parse_post(item, x: config.Language):
                         links_list_rep,
                         videos_list_rep,
                         photo_url_list_rep,
-                        docs_list_rep,
+                        documents_rep,
                     )
                 text_of_post_rep = compile_links_and_text(
                     item["id"],
@@ -580,189 +1209,1221 @@ def parse_post(item, x: config.Language):
                     link_to_reposted_post,
                     group_name,
                 )
-                send_posts(
-                    item["id"],
-                    text_of_post_rep,
-                    photo_url_list_rep,
-                    docs_list_rep,
-                    x,
+                post["parts"].append(
+                    {"text": text_of_post_rep, "photos": photo_url_list_rep, "documents": documents_rep, "docs": []}
                 )
         except Exception as ex:
             add_log(
                 "e",
-                f'[id:{item["id"]}] [{type(ex).__name__}] in parse_posts(): {str(ex)}',
+                f'[{type(ex).__name__}] in parse_post(): {str(ex)}',
                 x,
+                postid=item["id"],
             )
+    return post
+
+
+def get_document_key(document):
+    """Key of a VK document in file_id_cache, its URL changes from request to request"""
+    if "owner_id" in document and "id" in document:
+        return f"doc{document['owner_id']}_{document['id']}"
+    return document["url"]
+
 
+def download_document(url, title, size, post):
+    """Streams a document into the workspace of the post,
+    the space for it is reserved with reserve_temp_space().
+    VK doesn't always report the right size, so more space is reserved
+    while the file grows past it
 
-def get_data(x: config.Language):
-    """Trying to request data from VK using vk_api
+    Args:
+        url (string): Document URL
+        title (string): Document title, used as file name
+        size (int): Document size reported by VK
+        post (dict): Post from parse_post()
 
     Returns:
-        List of N posts from vk.com/xxx, where
-            N = config.req_count
-            xxx = config.vk_domain
+        string: Path to the downloaded file
+
+    Raises:
+        DocumentTooLargeError: The file is bigger than config.max_document_size
+        TempDiskQuotaError: There was no space for the file
     """
-    timeout = eventlet.Timeout(20)
+    workspace = get_post_workspace(post)
+    if not reserve_temp_space(workspace, size):
+        raise TempDiskQuotaError(f"no space for {size} bytes")
+    reserved = size
+
+    def reserve_more(file_size):
+        nonlocal reserved
+        if file_size <= reserved:
+            return True
+        if not reserve_temp_space(workspace, file_size - reserved):
+            return False
+        reserved = file_size
+        return True
+
+    document_path = f"{workspace}/{next(post['file_numbers'])}_{get_safe_file_name(title)}"
+    with tracing.span("download.document", size=size):
+        download_file(url, document_path, config.max_document_size, reserve_more)
+    return document_path
+
+
+def get_doc(document, post, is_cached=False):
+    """Downloads one document of the post into its workspace
+
+    Args:
+        document (dict): "doc" attachment from VK
+        post (dict): Post from parse_post()
+        is_cached (bool): The document is in file_id_cache and is not downloaded
+
+    Returns:
+        dict: Document for send_docs(), None if it was skipped
+    """
+    x = post["x"]
+    document_types = {
+        1: "text_document",
+        2: "archive",
+        3: "gif",
+        4: "image",
+        5: "audio",
+        6: "video",
+        7: "ebook",
+        8: "unknown",
+    }
+    document_key = get_document_key(document)
     try:
-        data = requests.get(
-            "https://api.vk.com/method/wall.get",
-            params={
-                "access_token": x.vk_token,
-                "v": x.req_version,
-                "domain": x.vk_domain,
-                "filter": x.req_filter,
-                "count": x.req_count,
-            },
+        document_type = document_types[document["type"]]
+        if is_cached:  # uploaded before, send_docs() doesn't need the file
+            return {
+                "type": document_type,
+                "title": document["title"],
+                "url": document["url"],
+                "key": document_key,
+                "size": document["size"],
+                "hash": None,
+                "path": None,
+            }
+        if document["size"] > config.max_document_size:
+            add_log("i", "Document [%s] skipped because it > 50 MB", x, document["type"], postid=post["id"])
+            return
+        with tracing.activate(post["trace"]):
+            document_path = download_document(document["url"], document["title"], document["size"], post)
+        document_hash = get_file_hash(document_path)
+    except DocumentTooLargeError:
+        add_log("i", "Document [%s] skipped because it > 50 MB", x, document["type"], postid=post["id"])
+        return
+    except TempDiskQuotaError:
+        add_log("w", f"Document [{document['type']}] skipped because temp disk quota is full", x, postid=post['id'])
+        return
+    except Exception as ex:
+        add_log(
+            "e",
+            f'[{type(ex).__name__}] in get_doc(): {str(ex)}',
+            x,
+            postid=post["id"],
         )
-        return data.json()["response"]["items"]
-    except eventlet.timeout.Timeout:
+        return
+
+    return {
+        "type": document_type,
+        "title": document["title"],
+        "url": document["url"],
+        "key": document_key,
+        "size": document["size"],
+        "hash": document_hash,
+        "path": document_path,
+    }
+
+
+def download_post(post):
+    """Downloads documents of all parts of the post into a new workspace,
+    at most config.doc_download_workers at the same time.
+    Documents that were uploaded to Telegram before are not downloaded,
+    the workspace is created for the first downloaded file
+
+    Args:
+        post (dict): Post from parse_post()
+    """
+    for part in post["parts"]:
+        if not part["documents"]:
+            continue
+        cached = [bool(file_id_cache.get(get_document_key(document))) for document in part["documents"]]
+        with ThreadPoolExecutor(max_workers=config.doc_download_workers) as downloader:
+            for doc_data in downloader.map(get_doc, part["documents"], itertools.repeat(post), cached):
+                if doc_data:
+                    part["docs"].append(doc_data)
+
+
+def submit_post(item, x: config.Language):
+    """Puts a fresh post into the pipeline:
+        parse_stage() -> download_stage() -> send_stage()
+    Each stage has its own workers and a bounded queue, so VK lookups,
+    downloads and uploads of different posts run at the same time.
+    The post is parsed and downloaded once and then delivered to every
+    target channel of the language it was not sent to yet.
+    Blocks while the parse queue is full
+
+    Args:
+        item json file from request: Post received from VK
+        x (config.Language): Current language
+
+    Returns:
+        [bool]: False if the post is already in the pipeline or in the retry queue
+            or there is no target channel left for it
+    """
+    global deliveries_in_pipeline
+    state_store = get_state_store(x)
+    targets = [tg_channel for tg_channel in x.tg_channels if not state_store.is_sent(item["id"], tg_channel)]
+    with pipeline_lock:
+        if not targets or (x, item["id"]) in pending_post_ids:
+            return False
+        pending_post_ids.add((x, item["id"]))
+        deliveries_in_pipeline += len(targets)
+        seqs = {tg_channel: get_next_channel_seq(tg_channel) for tg_channel in targets}
+    trace = tracing.start_trace("post", post_id=item["id"], source=x.vk_domain)
+    parse_queue.put((item, x, seqs, trace))
+    return True
+
+
+def get_next_channel_seq(tg_channel):
+    """Numbers posts of every channel in the order they were submitted,
+    send_stage() sends them in exactly this order. Call with pipeline_lock held"""
+    channel = channel_sequences.setdefault(
+        tg_channel, {"last_seq": 0, "next_seq": 1, "waiting": {}, "busy": False, "deferred": False}
+    )
+    channel["last_seq"] += 1
+    return channel["last_seq"]
+
+
+def create_delivery(post, tg_channel, seq):
+    """One post going to one target channel, all deliveries of a post share its parts"""
+    return {
+        "post": post,
+        "tg_channel": tg_channel,
+        "seq": seq,
+        "sent_messages": 0,
+        "attempts": 0,
+    }
+
+
+def parse_stage():
+    """Pipeline worker: parse_queue -> parse_post() -> download_queue"""
+    while True:
+        item, x, seqs, trace = parse_queue.get()
+        try:
+            with metrics.parse_seconds.time(source=x.vk_domain), tracing.activate(trace), tracing.span("parse_post"):
+                post = parse_post(item, x)
+        except Exception as ex:
+            add_log("e", f"[{type(ex).__name__}] in parse_stage(): {str(ex)}", x, postid=item['id'])
+            post = create_post(item, x)
+            post["parse_failed"] = True  # only takes its place in the channel order, see send_stage()
+        post["seqs"] = seqs
+        post["trace"] = trace
+        download_queue.put(post)
+
+
+def download_stage():
+    """Pipeline worker: download_queue -> download_post() -> send_queue (once for every target)"""
+    while True:
+        post = download_queue.get()
+        try:
+            with tracing.activate(post["trace"]), tracing.span("download_post"):
+                download_post(post)
+        except Exception as ex:
+            add_log("e", f"[{type(ex).__name__}] in download_stage(): {str(ex)}", post["x"], postid=post['id'])
+        post["deliveries_left"] = len(post["seqs"])
+        for tg_channel, seq in post["seqs"].items():
+            send_queue.put(create_delivery(post, tg_channel, seq))
+
+
+def send_stage():
+    """Pipeline worker: send_queue -> deliver_post().
+    Posts of one channel are sent by one worker at a time and strictly
+    in the order they were submitted, posts that came too early wait.
+    Posts that could not be parsed are released without being marked as sent"""
+    while True:
+        delivery = send_queue.get()
+        with pipeline_lock:
+            channel = channel_sequences[delivery["tg_channel"]]
+            channel["waiting"][delivery["seq"]] = delivery
+            if channel["busy"]:
+                continue
+            channel["busy"] = True
+        while True:
+            with pipeline_lock:
+                delivery = channel["waiting"].pop(channel["next_seq"], None)
+                if delivery is None:
+                    channel["busy"] = False
+                    break
+                channel["next_seq"] += 1
+                deferred = channel["deferred"]
+            try:
+                if delivery["post"]["parse_failed"]:
+                    finish_delivery(delivery, delivered=False)
+                elif deferred or not deliver_post(delivery):
+                    with pipeline_lock:  # later posts of the channel wait behind this one
+                        channel["deferred"] = True
+                    defer_delivery(delivery)
+                else:
+                    finish_delivery(delivery)
+            except Exception as ex:
+                post = delivery["post"]
+                add_log("e", f"[{type(ex).__name__}] in send_stage(): {str(ex)}", post["x"], postid=post['id'])
+                finish_delivery(delivery)
+
+
+def finish_delivery(delivery, delivered=True):
+    """Marks the post as sent to the target channel only after it was delivered.
+    When the post is done for all targets, its files are removed.
+    The watermark is only moved by check_new_post(), so it never passes
+    an older post that is still in the pipeline or could not be parsed
+
+    Args:
+        delivery (dict): Delivery from create_delivery()
+        delivered (bool): False releases the delivery without marking the post as sent,
+            the next check_new_post() gets and submits the post again
+    """
+    global deliveries_in_pipeline
+    post = delivery["post"]
+    x = post["x"]
+    try:
+        with pipeline_lock:
+            post["deliveries_left"] -= 1
+            post_done = post["deliveries_left"] == 0
+        if delivered:
+            state_store = get_state_store(x)
+            state_store.mark_sent(post["id"], delivery["tg_channel"])
+            metrics.posts_delivered.inc(source=x.vk_domain)
+            state_store.flush()
+    except Exception as ex:
+        post_done = True
+        add_log("e", f"[{type(ex).__name__}] in finish_delivery(): {str(ex)}", x, postid=post['id'])
+    if post_done:
+        tracing.end_trace(post["trace"], channels=len(post["seqs"]))
+    if post_done and post["workspace"] is not None:
+        remove_post_workspace(post["workspace"])
+    with pipeline_lock:
+        if post_done:
+            pending_post_ids.discard((x, post["id"]))
+        deliveries_in_pipeline -= 1
+        pipeline_idle.notify_all()
+
+
+def defer_delivery(delivery):
+    """Puts a delivery that could not be sent into the retry queue.
+    After config.retry_queue_max_attempts failed attempts it is given up"""
+    global deliveries_in_pipeline
+    if delivery["attempts"] >= config.retry_queue_max_attempts:
+        post = delivery["post"]
+        add_log(
+            "e",
+            f"Post was not sent to {delivery['tg_channel']} after {delivery['attempts']} attempts, giving up",
+            post["x"],
+            postid=post['id'],
+        )
+        finish_delivery(delivery)
+        return
+    with pipeline_lock:
+        retry_queue.append(delivery)
+        deliveries_in_pipeline -= 1
+        pipeline_idle.notify_all()
+
+
+def retry_deferred_posts():
+    """Puts deliveries from the retry queue back into the send stage,
+    in the order they were deferred and before any new post"""
+    global deliveries_in_pipeline
+    with pipeline_lock:
+        deferred_deliveries = retry_queue[:]
+        retry_queue.clear()
+        for channel in channel_sequences.values():
+            channel["deferred"] = False
+        for delivery in deferred_deliveries:
+            delivery["seq"] = get_next_channel_seq(delivery["tg_channel"])
+            deliveries_in_pipeline += 1
+    for delivery in deferred_deliveries:
+        send_queue.put(delivery)
+
+
+def wait_for_pipeline():
+    """Waits until every submitted post is sent or deferred"""
+    with pipeline_lock:
+        while deliveries_in_pipeline > 0:
+            pipeline_idle.wait()
+
+
+def start_pipeline():
+    """Starts worker threads of all pipeline stages"""
+    stages = (
+        (parse_stage, config.parse_workers),
+        (download_stage, config.download_workers),
+        (send_stage, config.send_workers),
+    )
+    for stage, workers in stages:
+        for number in range(max(1, workers)):
+            threading.Thread(target=stage, name=f"{stage.__name__}-{number}", daemon=True).start()
+
+
+def get_data(x: config.Language, watermark=None, first_page=None):
+    """Trying to request data from VK using vk_api.
+    If the newest known post id (watermark) is given, older pages are requested
+    with offset until a known post is reached, so posts published while the bot
+    was down are not lost. The pinned post is never used to decide where to stop
+
+    Args:
+        x (config.Language): Current language
+        watermark (integer): Newest known post id, None loads only the first page
+        first_page (dict): wall.get answer for offset 0 if it was already requested by fetch_first_pages()
+
+    Returns:
+        List of posts from vk.com/xxx (oldest first), where
+            xxx = config.vk_domain
+        At most config.catch_up_max_posts newest posts are returned
+    """
+    try:
+        posts = []
+        offset = 0
+        while True:
+            if offset == 0 and first_page is not None:
+                data = first_page
+            else:
+                data = vk_api(
+                    "wall.get",
+                    x,
+                    domain=x.vk_domain,
+                    filter=x.req_filter,
+                    count=x.req_count,
+                    offset=offset,
+                )
+            if offset == 0:
+                record_post_dates(x, data["items"], seed=True)
+            reached_known_post = watermark is None
+            for post in data["items"]:
+                if post.get("is_pinned"):
+                    if offset == 0:
+                        posts.append(post)
+                elif watermark is not None and post["id"] <= watermark:
+                    reached_known_post = True
+                    break
+                else:
+                    posts.append(post)
+            offset += len(data["items"])
+            if (
+                reached_known_post
+                or len(data["items"]) < x.req_count
+                or len(posts) >= config.catch_up_max_posts
+            ):
+                break
+        if len(posts) >= config.catch_up_max_posts and not reached_known_post:
+            add_log(
+                "w",
+                f"More than {config.catch_up_max_posts} new posts, older ones are skipped",
+                x,
+            )
+        return list(reversed(posts[: config.catch_up_max_posts]))
+    except requests.exceptions.Timeout:
         add_log("w", "Got Timeout while retrieving VK JSON data from " + x.vk_domain + ". Cancelling..", x)
         return None
-    finally:
-        timeout.cancel()
 
 
-def check_admin_status(specific_bot: telebot.TeleBot, x: config.Language):
-    """Checks if the bot is a channel administrator
+def fetch_first_pages(languages):
+    """Requests the first wall.get page of many languages at once.
+    Languages with the same vk_token are grouped, and every group is requested
+    with VK "execute" calls of up to config.vk_execute_batch_size walls each
+
+    Args:
+        languages (list): config.Language items
+
+    Returns:
+        dict: config.Language -> wall.get answer. Languages whose wall could not
+            be requested this way are missing and should call get_data() on their own
+    """
+    first_pages = {}
+    if config.vk_execute_batch_size <= 1:
+        return first_pages
+    groups = {}
+    for language in languages:
+        groups.setdefault((language.vk_token, language.req_version), []).append(language)
+
+    for group in groups.values():
+        for start in range(0, len(group), config.vk_execute_batch_size):
+            batch = group[start : start + config.vk_execute_batch_size]
+            calls = ",".join(
+                "API.wall.get("
+                + json.dumps(
+                    {
+                        "domain": language.vk_domain,
+                        "filter": language.req_filter,
+                        "count": language.req_count,
+                        "offset": 0,
+                    }
+                )
+                + ")"
+                for language in batch
+            )
+            try:
+                data = vk_api_request("execute", batch[0], code=f"return [{calls}];")
+            except Exception as ex:
+                add_log("e", f"[{type(ex).__name__}] in fetch_first_pages(): {str(ex)}", batch[0])
+                continue
+            execute_errors = iter(data.get("execute_errors", []))
+            for language, first_page in zip(batch, data["response"]):
+                if first_page:
+                    first_pages[language] = first_page
+                else:
+                    error = next(execute_errors, {})
+                    add_log(
+                        "e",
+                        f"[VkApiError] wall.get in fetch_first_pages(): [{error.get('error_code')}] {error.get('error_msg')}",
+                        language,
+                    )
+    return first_pages
+
+
+def check_admin_status(specific_bot: telebot.TeleBot, x: config.Language, tg_channel=None):
+    """Checks if the bot is a channel administrator.
+    The answer is cached for config.admin_status_ttl seconds for every bot and channel
 
     Args:
         specific_bot (string): Defines which bot will be checked
         x (config.Language): get tg channel name from here
+        tg_channel: Channel to check, x.tg_channel if not given
     """
     if x == config.Dummy:
         return False
-    else:
-        try:
-            _ = specific_bot.get_chat_administrators(x.tg_channel)
+    if tg_channel is None:
+        tg_channel = x.tg_channel
+    key = (specific_bot.token, tg_channel)
+    with admin_status_cache_lock:
+        cached = admin_status_cache.get(key)
+    if cached is not None and time.monotonic() - cached[1] < config.admin_status_ttl:
+        return cached[0]
+
+    try:
+        _ = specific_bot.get_chat_administrators(tg_channel)
+        is_admin = True
+    except Exception:
+        add_log(
+            "e",
+            f"Bot is not channel admin [{tg_channel}] or Telegram Servers are down..\n",
+            x,
+        )
+        is_admin = False
+    with admin_status_cache_lock:
+        admin_status_cache[key] = (is_admin, time.monotonic())
+    return is_admin
+
+
+def invalidate_admin_status(specific_bot: telebot.TeleBot, tg_channel):
+    """Forgets the cached check_admin_status() answer for this bot and channel"""
+    with admin_status_cache_lock:
+        admin_status_cache.pop((specific_bot.token, tg_channel), None)
+
+
+def is_permission_error(ex: Exception):
+    """Checks if Telegram refused to send a message because of missing rights
+
+    Args:
+        ex (Exception): Exception raised by a bot.send_* method
+
+    Returns:
+        [bool]
+    """
+    if not isinstance(ex, telebot.apihelper.ApiTelegramException):
+        return False
+    description = str(ex.description).lower()
+    return ex.error_code == 403 or (
+        ex.error_code == 400
+        and any(word in description for word in ("rights", "admin", "forbidden", "chat not found"))
+    )
+
+
+def is_url_rejected_error(ex: telebot.apihelper.ApiTelegramException):
+    """Checks if Telegram could not download a file by the URL it was given"""
+    return ex.error_code == 400 and not is_permission_error(ex)
+
+
+def claim_media_upload(key):
+    """Channels that send the same media at the same time let only the first one upload it.
+    If another channel is uploading the media right now, waits until it is done
+    (at most config.media_upload_wait seconds), its file_id is in file_id_cache then.
+    Nothing is locked while Telegram is called, so other media are never held up
+
+    Args:
+        key: file_id_cache key of the media
+
+    Returns:
+        [bool]: True if the caller uploads the media and has to call release_media_upload(key)
+    """
+    with media_uploads_lock:
+        upload_done = media_uploads.get(key)
+        if upload_done is None:
+            media_uploads[key] = threading.Event()
             return True
-        except Exception:
-            add_log(
-                "e",
-                f"Bot is not channel admin [{x.tg_channel}] or Telegram Servers are down..\n",
-                x,
+    with tracing.span("wait.media_upload"):
+        upload_done.wait(config.media_upload_wait)
+    return False
+
+
+def release_media_upload(key):
+    """Wakes up channels waiting in claim_media_upload(key)"""
+    with media_uploads_lock:
+        media_uploads.pop(key).set()
+
+
+def is_file_id_rejected_error(ex: Exception):
+    """Checks if Telegram does not know a file_id from file_id_cache (any more)"""
+    return isinstance(ex, telebot.apihelper.ApiTelegramException) and is_url_rejected_error(ex)
+
+
+class TokenBucket:
+    """Allows `rate` calls per second with bursts of up to `capacity` calls.
+    Callers reserve a token and get the time they have to wait for it,
+    so waiting callers are served in the order they came"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            return max(wait, self.blocked_until - now)
+
+    def block_for(self, seconds):
+        """Nobody gets a token in the next `seconds` seconds (Telegram asked to wait)"""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+def get_telegram_buckets(specific_bot: telebot.TeleBot, chat_id):
+    """Returns the bot-wide and the chat rate limit buckets"""
+    with telegram_buckets_lock:
+        if specific_bot.token not in telegram_buckets:
+            telegram_buckets[specific_bot.token] = TokenBucket(
+                config.tg_messages_per_second, config.tg_messages_per_second
             )
-            return False
+        if (specific_bot.token, chat_id) not in telegram_buckets:
+            telegram_buckets[(specific_bot.token, chat_id)] = TokenBucket(
+                config.tg_messages_per_minute_per_chat / 60, config.tg_chat_burst
+            )
+        return telegram_buckets[specific_bot.token], telegram_buckets[(specific_bot.token, chat_id)]
+
+
+def get_retry_after(ex: Exception):
+    """Returns how many seconds Telegram asked to wait, or None if it is not a flood error"""
+    if isinstance(ex, telebot.apihelper.ApiTelegramException) and ex.error_code == 429:
+        try:
+            return int(ex.result_json["parameters"]["retry_after"])
+        except (KeyError, TypeError, ValueError):
+            return 1
+    return None
+
+
+def telegram_call(specific_bot: telebot.TeleBot, method, chat_id, *args, **kwargs):
+    """Every bot.send_* call goes through here. Calls are paced by a bot-wide
+    and a per chat token bucket, and "429 Too Many Requests" answers block
+    the chat for exactly retry_after seconds before the call is repeated
+
+    Args:
+        specific_bot (telebot.TeleBot): Bot that sends the message
+        method (string): TeleBot method, e.g. send_message
+        chat_id: Chat id or @domain
+        *args, **kwargs: Passed to the method after chat_id
+
+    Returns:
+        Whatever the method returns
+    """
+    global_bucket, chat_bucket = get_telegram_buckets(specific_bot, chat_id)
+    for attempt in range(config.tg_flood_retries + 1):
+        wait = max(global_bucket.reserve(), chat_bucket.reserve())
+        if wait > 0:
+            with tracing.span("sleep.telegram_rate_limit"):
+                time.sleep(wait)
+        try:
+            with tracing.span("telegram." + method, chat=chat_id):
+                result = getattr(specific_bot, method)(chat_id, *args, **kwargs)
+            metrics.telegram_requests.inc(method=method, result="ok")
+            return result
+        except telebot.apihelper.ApiTelegramException as ex:
+            retry_after = get_retry_after(ex)
+            metrics.telegram_requests.inc(method=method, result="error" if retry_after is None else "flood_wait")
+            if retry_after is None or attempt == config.tg_flood_retries:
+                raise
+            chat_bucket.block_for(retry_after)
+            for argument in list(args) + list(kwargs.values()):
+                if hasattr(argument, "seek"):  # file is read again on the next attempt
+                    argument.seek(0)
+        except Exception:
+            metrics.telegram_requests.inc(method=method, result="network_error")
+            raise
+
+
+def handle_send_error(specific_bot: telebot.TeleBot, tg_channel, ex: Exception):
+    """Makes the next check_admin_status() ask Telegram again
+    if a message was not sent because of missing rights"""
+    if is_permission_error(ex):
+        invalidate_admin_status(specific_bot, tg_channel)
+
+
+def get_state_store(x: config.Language):
+    """Returns the sent posts store of the language, it is opened on first use"""
+    with state_stores_lock:
+        if x not in state_stores:
+            state_stores[x] = storage.open_state_store(x)
+        return state_stores[x]
+
+
+def record_post_dates(x: config.Language, posts, seed=False):
+    """Remembers dates of the latest config.poll_history_size posts of the source,
+    get_poll_interval() tells from them how often the source posts
+
+    Args:
+        x (config.Language): Language of the posts
+        posts (list): wall.get items, the pinned post is ignored
+        seed (bool): Only fill the history if there is none yet (first page after start)
+    """
+    with poll_schedule_lock:
+        if seed and x in post_dates:
+            return
+        history = post_dates.setdefault(x, {})
+        for post in posts:
+            if "date" in post and not post.get("is_pinned"):
+                history[post["id"]] = post["date"]
+        for post_id in sorted(history, key=history.get)[: -max(2, config.poll_history_size)]:
+            del history[post_id]
+
+
+def get_poll_interval(x: config.Language, check_failed=False):
+    """Picks how long to wait before the next check of the source.
+    With config.adaptive_polling the interval follows the usual time between
+    the latest posts from record_post_dates() (or the time since the last post
+    if the source went quiet), between config.poll_interval_min and config.poll_interval_max
+
+    Args:
+        x (config.Language): Checked language
+        check_failed (bool): The check failed, the last interval is kept
+
+    Returns:
+        float: Seconds
+    """
+    if not config.adaptive_polling:
+        return config.time_to_sleep
+    with poll_schedule_lock:
+        if check_failed:
+            return poll_intervals.get(x, config.poll_interval_min)
+        dates = sorted(post_dates.get(x, {}).values(), reverse=True)
+    if not dates:
+        return config.poll_interval_max
+    quiet_for = time.time() - dates[0]
+    if len(dates) < 2:
+        usual_gap = quiet_for
+    else:
+        usual_gap = statistics.median(newer - older for newer, older in zip(dates, dates[1:]))
+    interval = max(usual_gap, quiet_for) * config.poll_interval_factor
+    return min(config.poll_interval_max, max(config.poll_interval_min, interval))
+
 
+def schedule_next_poll(x: config.Language, interval, checked_at):
+    """Sets when the source is checked next. With config.adaptive_polling
+    the interval gets some jitter and all intervals are stretched when
+    together they would make more than config.poll_budget_per_hour checks
 
-def check_new_post(x: config.Language):
+    Args:
+        x (config.Language): Checked language
+        interval (float): Seconds from get_poll_interval()
+        checked_at (float): time.monotonic() when the check started
+    """
+    with poll_schedule_lock:
+        poll_intervals[x] = interval
+        if config.adaptive_polling:
+            checks_per_hour = sum(60 * 60 / seconds for seconds in poll_intervals.values())
+            interval *= max(1, checks_per_hour / config.poll_budget_per_hour)
+            interval *= 1 + random.uniform(-config.poll_interval_jitter, config.poll_interval_jitter)
+        next_poll_at[x] = checked_at + interval
+
+
+def is_poll_due(x: config.Language):
+    """Checks if the source should be checked in this cycle"""
+    with poll_schedule_lock:
+        return next_poll_at.get(x, 0) <= time.monotonic() + config.poll_batch_window
+
+
+def get_time_to_next_poll():
+    """Seconds until the next source is due, at most config.time_to_sleep,
+    so posts from the retry queue are not kept waiting for quiet sources"""
+    with poll_schedule_lock:
+        due_times = [
+            next_poll_at.get(x, 0) for x in config.list_of_languages if x.input_mode == "poll"
+        ]
+    if not due_times:
+        return config.time_to_sleep
+    return max(0, min(config.time_to_sleep, min(due_times) - time.monotonic()))
+
+
+def check_new_post(x: config.Language, first_page=None):
     """Gets list of posts from get_data(),
-    compares posts ids with ids from the *languge*.json file.
-    Sends posts one by one to parse_posts(), writes new posts into .json"""
-    if not check_admin_status(bot, x):
-        add_log("w", f"There is no admin permission for the bot in a chat ", x)
-        pass
+    compares posts ids with ids from the state store of the language.
+    Puts new posts into the pipeline with submit_post(), oldest first.
+    They are marked as sent by the send stage. Plans the next check of the source"""
+    checked_at = time.monotonic()
+    feed = None
+    for tg_channel in x.tg_channels:
+        if not check_admin_status(bot, x, tg_channel):
+            add_log("w", f"There is no admin permission for the bot in a chat {tg_channel}", x)
     add_log("i", "Scanning for new posts in ", x)
-    with open(WORKING_DIR + '/jsons/' + x.jsonfile, "r") as file:
-        try:
-            sent_ids = json.load(file)
-            ###
-            #   sent_ids = [684, 98789, 654654, 6546]
-            ###
-        except:
-            add_log("e", "Could not read from storage. Skipped iteration for ", x)
-            pass
     try:
-        feed = get_data(x)
-        if feed is not None:
-            for post in feed:
-                if post['id'] not in sent_ids:
-                    add_log("i", f"Got fresh post id:{post['id']}", x)
-                    parse_post(post, x)
-                    sent_ids.append(post['id'])
-            if len(sent_ids) > MAX_IDS_PER_JSON:
-                sent_ids = sent_ids[-MAX_IDS_PER_JSON:]
-            with open(WORKING_DIR + '/jsons/' + x.jsonfile, "w") as file:
-                json.dump(sent_ids, file)
+        state_store = get_state_store(x)
     except Exception as ex:
+        add_log("e", f"[{type(ex).__name__}] Could not read from storage. Skipped iteration for ", x)
+        schedule_next_poll(x, get_poll_interval(x, check_failed=True), checked_at)
+        return
+    try:
+        with metrics.fetch_seconds.time(source=x.vk_domain):
+            feed = get_data(x, state_store.get_watermark(), first_page)
+        if feed is None:
+            metrics.fetch_errors.inc(source=x.vk_domain)
+        else:
+            fresh_posts = [
+                post for post in feed
+                if not all(state_store.is_sent(post['id'], tg_channel) for tg_channel in x.tg_channels)
+            ]
+            prefetch_repost_group_names(fresh_posts, x)
+            record_post_dates(x, fresh_posts)
+            for post in fresh_posts:
+                if submit_post(post, x):
+                    add_log("i", "Got fresh post", x, postid=post["id"])
+            for post in feed:  # watermark never passes a post that is not sent yet
+                if post.get("is_pinned"):
+                    continue
+                if not all(state_store.is_sent(post['id'], tg_channel) for tg_channel in x.tg_channels):
+                    break
+                state_store.set_watermark(post['id'])
+            state_store.flush()
+    except Exception as ex:
+        metrics.fetch_errors.inc(source=x.vk_domain)
         add_log("e", f"[{type(ex).__name__}] in check_new_post(): {str(ex)}", x)
+    schedule_next_poll(x, get_poll_interval(x, check_failed=feed is None), checked_at)
     add_log("i", "Scanning finished", x)
 
 
-def send_log(log_message, x: config.Language):
-    """Sends logs to config.tg_log_channel channel
+def run_cycle(executor: ThreadPoolExecutor, catch_up=False):
+    """Checks sources from config.list_of_languages that are due (see schedule_next_poll()) in parallel.
+    At most config.max_workers sources are checked at the same time,
+    so one cycle takes about as long as the slowest source.
+    First pages of all walls are requested in batches beforehand,
+    posts from the retry queue are sent again before new ones.
+    Returns when all posts of the cycle are sent or deferred
 
     Args:
-        log_message (string): Logging text
-        x (Language class): In order to know which vk.com/@xxx to add to the end of a log message
+        executor (ThreadPoolExecutor): Worker pool shared between cycles
+        catch_up (bool): Also check sources that push their posts (input_mode="callback" or "longpoll"),
+            used once after start to get posts published while the bot was down
     """
+    cycle_started = time.monotonic()
+    retry_deferred_posts()
+
+    languages = [x for x in config.list_of_languages if catch_up or (x.input_mode == "poll" and is_poll_due(x))]
+    first_pages = fetch_first_pages(languages)
+    futures = {
+        executor.submit(check_new_post, language, first_pages.get(language)): language
+        for language in languages
+    }
+    for future, language in futures.items():
+        try:
+            future.result()
+        except Exception as ex:
+            add_log("e", f"[{type(ex).__name__}] in run_cycle(): {str(ex)}", language)
+    wait_for_pipeline()
     try:
-        log_message_temp = (
-            f"<code>{log_message}</code>\n"
-            f"tg_channel = {config.tg_log_channel}\n"
-            f"vk_domain = <code>{x.vk_domain}</code>"
-        )
-        bot_2.send_message(
-            config.tg_log_channel, log_message_temp, parse_mode="HTML"
-        )
+        file_id_cache.flush()
     except Exception as ex:
-        global logger
-        logger.error(f"[{type(ex).__name__}] in send_log(): {str(ex)}")
+        add_log("e", f"[{type(ex).__name__}] in file_id_cache.flush(): {str(ex)}", config.Dummy)
+    metrics.cycle_seconds.observe(time.monotonic() - cycle_started)
 
 
-def add_log(type_of_log: str, text: str, x: config.Language):
-    """Unifies logging and makes it easier to use
+def submit_pushed_post(post, x: config.Language, input_name):
+    """Puts a post from a wall_post_new event into the pipeline,
+    suggested and postponed posts are skipped
 
     Args:
-        type_of_log (string): Type of logging message (warning / info / error)
-        text (string): Logging text
-        x (Language class): Config-defined language
+        post (dict): "object" of the event, the same as a wall.get item
+        x (config.Language): Language of the community
+        input_name (string): Where the event came from, for logging
     """
-    types = {"w": "WARNING", "i": "INFO", "e": "ERROR"}
-    log_message = f"[{types[type_of_log]}] {text}"
-    if type_of_log == "w":  # WARNING
-        logger.warning(text)
-    elif type_of_log == "i":  # INFO
-        logger.info(text)
-    elif type_of_log == "e":  # ERROR
-        logger.error(text)
+    if post.get("post_type", "post") != "post":
+        return
+    record_post_dates(x, [post])
+    if submit_post(post, x):
+        add_log("i", "Got fresh post from %s", x, input_name, postid=post["id"])
 
-    global is_bot_for_log
-    if is_bot_for_log and check_admin_status(bot_2, x):
-        time.sleep(1)
-        send_log(log_message, x)
 
+def get_callback_language(group_id):
+    """Finds the language that receives Callback API events of the community"""
+    for x in config.list_of_languages:
+        if x.input_mode == "callback" and group_id is not None and x.group_id == abs(int(group_id)):
+            return x
+    return None
 
-def check_python_version():
-    """Checks Python version.
-    Will close script if Python version is lower than required
+
+def handle_callback_event(event):
+    """Handles one VK Callback API event
+
+    Args:
+        event (dict): Event sent by VK
+
+    Returns:
+        tuple: HTTP status and text of the answer, VK sends the event again until it gets "ok"
     """
-    if sys.version_info[0] == 2 or sys.version_info[1] <= 5:
-        print('Required python version for this bot is "3.6+"..\n')
-        exit()
+    x = get_callback_language(event.get("group_id"))
+    if x is None:
+        add_log("w", f"Callback event from unknown community {event.get('group_id')} was rejected", config.Dummy)
+        return 404, "unknown community"
+    if x.callback_secret and not hmac.compare_digest(str(event.get("secret", "")), x.callback_secret):
+        add_log("w", "Callback event with a wrong secret was rejected", x)
+        return 403, "wrong secret"
+    if event.get("type") == "confirmation":
+        add_log("i", "Callback API server address confirmed", x)
+        return 200, x.callback_confirmation
+    if event.get("type") == "wall_post_new":
+        submit_pushed_post(event["object"], x, "Callback API")
+    return 200, "ok"
+
+
+class VkCallbackHandler(BaseHTTPRequestHandler):
+    """Receives VK Callback API events, see start_callback_server()"""
+
+    def do_POST(self):
+        try:
+            event = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            status, answer = handle_callback_event(event)
+        except Exception as ex:
+            add_log("e", f"[{type(ex).__name__}] in VkCallbackHandler: {str(ex)}", config.Dummy)
+            status, answer = 400, "bad request"
+        answer = answer.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(answer)))
+        self.end_headers()
+        self.wfile.write(answer)
 
+    def log_message(self, format, *args):
+        pass  # events are logged by handle_callback_event()
 
-if __name__ == "__main__":
 
-    check_python_version()
+def start_callback_server():
+    """Starts the HTTP server for languages with input_mode="callback" in a background thread.
+    Their new posts go straight into the pipeline and they are not checked every cycle
 
-    if not os.path.exists(LOG_DIR):
-        os.makedirs(LOG_DIR)
+    Returns:
+        ThreadingHTTPServer or None if no language uses Callback API
+    """
+    if not any(x.input_mode == "callback" for x in config.list_of_languages):
+        return None
+    server = ThreadingHTTPServer((config.callback_server_host, config.callback_server_port), VkCallbackHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="vk-callback", daemon=True).start()
+    add_log(
+        "i",
+        f"Callback API server is listening on {config.callback_server_host}:{server.server_port}",
+        config.Dummy,
+    )
+    return server
 
-    logger = logging.getLogger('main-log-writer')
-    logger.setLevel(logging.DEBUG)
-    formatter = logging.Formatter('%(asctime)s - %(message)s')
-    logHandler = logging.handlers.RotatingFileHandler(LOG_DIR + '/' + config.logfile, maxBytes=1024 * 500, backupCount=3)
-    logHandler.setLevel(logging.DEBUG)
-    logHandler.setFormatter(formatter)
-    logger.addHandler(logHandler)
-    logger.info('\n------------\n Started script \n------------\n')
 
+def listen_long_poll(languages):
+    """Receives events of one community with Bots Long Poll API until stop_long_poll is set.
+    The server is requested again when VK says the key expired or the history is lost
+
+    Args:
+        languages (list): Languages with input_mode="longpoll" that use the same group token
+    """
+    x = languages[0]
+    server = None
+    kept_ts = None
+    while not stop_long_poll.is_set():
+        try:
+            if server is None:
+                server = vk_api("groups.getLongPollServer", x, group_id=x.group_id, access_token=x.group_token)
+                if kept_ts is not None:
+                    server["ts"] = kept_ts
+                    kept_ts = None
+                add_log("i", "Connected to Bots Long Poll API", x)
+            answer = http_get(
+                server["server"],
+                params={"act": "a_check", "key": server["key"], "ts": server["ts"], "wait": config.long_poll_wait},
+                timeout=(config.http_connect_timeout, config.long_poll_wait + config.http_read_timeout),
+            ).json()
+            if "failed" in answer:
+                if answer["failed"] == 1:  # some events were lost, continue from the given ts
+                    server["ts"] = answer["ts"]
+                elif answer["failed"] == 2:  # key expired, get a new one and continue from the same ts
+                    kept_ts = server["ts"]
+                    server = None
+                else:  # 3 - information is lost, get a new key and ts
+                    server = None
+                continue
+            server["ts"] = answer["ts"]
+            for update in answer.get("updates", []):
+                if update.get("type") != "wall_post_new":
+                    continue
+                for language in languages:
+                    if update["object"].get("owner_id") == -language.group_id:
+                        submit_pushed_post(update["object"], language, "Long Poll API")
+        except Exception as ex:
+            add_log("e", f"[{type(ex).__name__}] in listen_long_poll(): {str(ex)}", x)
+            server = None
+            stop_long_poll.wait(config.long_poll_error_delay)
+
+
+def start_long_poll_listeners():
+    """Starts one listen_long_poll() thread for every group token of languages with input_mode="longpoll".
+    Their new posts go straight into the pipeline and they are not checked every cycle"""
+    languages_by_token = {}
+    for x in config.list_of_languages:
+        if x.input_mode == "longpoll":
+            languages_by_token.setdefault(x.group_token, []).append(x)
+    for languages in languages_by_token.values():
+        threading.Thread(
+            target=listen_long_poll, args=(languages,), name=f"long-poll-{languages[0].group_id}", daemon=True
+        ).start()
+
+
+def send_log(log_messages, x: config.Language, max_messages=None):
+    """Sends logs to config.tg_log_channel channel.
+    Log lines are merged into as few messages as possible,
+    every message stays below the Telegram message size limit
+
+    Args:
+        log_messages (list): Logging texts
+        x (Language class): In order to know which vk.com/@xxx to add to the end of a log message
+        max_messages (int): Lines that don't fit into this many messages are not sent
+
+    Returns:
+        tuple: How many messages were sent and how many lines were not sent
+    """
+    footer = (
+        f"</code>\n"
+        f"tg_channel = {config.tg_log_channel}\n"
+        f"vk_domain = <code>{x.vk_domain}</code>"
+    )
+    room = TG_MESSAGE_LIMIT - len("<code>") - len(footer)
+    batches = [[]]
+    batch_length = 0
+    for log_message in log_messages:
+        line = ready_for_html(log_message)[: room - 1]
+        if batches[-1] and batch_length + len(line) + 1 > room:
+            batches.append([])
+            batch_length = 0
+        batches[-1].append(line)
+        batch_length += len(line) + 1
+
+    if max_messages is not None:
+        not_sent = sum(len(batch) for batch in batches[max_messages:])
+        batches = batches[:max_messages]
+    else:
+        not_sent = 0
+
+    sent = 0
+    for batch in batches:
+        try:
+            telegram_call(
+                bot_2, "send_message", config.tg_log_channel, "<code>" + "\n".join(batch) + footer, parse_mode="HTML"
+            )
+            sent += 1
+        except Exception as ex:
+            handle_send_error(bot_2, config.tg_log_channel, ex)
+            logger.error(f"[{type(ex).__name__}] in send_log(): {str(ex)}")
+    return sent, not_sent
+
+
+def flush_log_queue():
+    """Takes everything from log_queue and sends it to config.tg_log_channel
+    grouped by language. At most config.log_max_batches messages are sent,
+    lines that did not fit (or were dropped because the queue was full)
+    are replaced with a short summary
+    """
+    global dropped_log_lines
+    grouped = {}
+    while True:
+        try:
+            log_message, x = log_queue.get_nowait()
+        except queue.Empty:
+            break
+        grouped.setdefault(x, []).append(log_message)
+
+    with dropped_log_lines_lock:
+        dropped, dropped_log_lines = dropped_log_lines, 0
+
+    batches_left = config.log_max_batches
+    for x, log_messages in grouped.items():
+        if batches_left <= 0:
+            dropped += len(log_messages)
+        elif check_admin_status(bot_2, x, config.tg_log_channel):
+            sent, not_sent = send_log(log_messages, x, batches_left)
+            batches_left -= sent
+            dropped += not_sent
+
+    if dropped:
+        try:
+            telegram_call(
+                bot_2,
+                "send_message",
+                config.tg_log_channel,
+                f"<code>[WARNING] {dropped} log line(s) were not sent to this channel, see {config.logfile}</code>",
+                parse_mode="HTML",
+            )
+        except Exception as ex:
+            logger.error(f"[{type(ex).__name__}] in flush_log_queue(): {str(ex)}")
+
+
+def forward_logs():
+    """Background thread that sends queued logs every config.log_batch_interval seconds"""
+    while not stop_log_forwarder.wait(config.log_batch_interval):
+        flush_log_queue()
+    flush_log_queue()
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Writes every record as one JSON line, vk_domain and postid are separate fields"""
+
+    def format(self, record):
+        log_record = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "message": record.getMessage(),
+            "vk_domain": getattr(record, "vk_domain", None),
+            "postid": getattr(record, "postid", None),
+            "thread": record.threadName,
+        }
+        if record.exc_info:
+            log_record["exception"] = self.formatException(record.exc_info)
+        return json.dumps(log_record, ensure_ascii=False)
+
+
+class TextLogFormatter(logging.Formatter):
+    """Writes "<time> - [id:<postid>] <message>" lines like the log had before JSON"""
+
+    def format(self, record):
+        postid = getattr(record, "postid", None)
+        line = f"{self.formatTime(record)} - " + (f"[id:{postid}] " if postid is not None else "") + record.getMessage()
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Puts records into file_log_queue as they are, the message is formatted
+    by the listener thread and not by the thread that logs it"""
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging():
+    """Moves file logging to a background thread: logger only puts records into
+    file_log_queue, a QueueListener formats them and writes them to logs/config.logfile.
+    Records below config.log_level are dropped before they are formatted
+
+    Returns:
+        logging.handlers.QueueListener: Stop it before exit, so the last records are written
+    """
+    os.makedirs(LOG_DIR, exist_ok=True)
+    file_handler = logging.handlers.RotatingFileHandler(
+        LOG_DIR + '/' + config.logfile, maxBytes=1024 * 500, backupCount=3, encoding="utf-8"
+    )
+    file_handler.setFormatter(JsonLogFormatter() if config.log_format == "json" else TextLogFormatter())
+    listener = logging.handlers.QueueListener(file_log_queue, file_handler)
+    logger.handlers = [LogQueueHandler(file_log_queue)]
+    logger.setLevel(config.log_level)
+    logger.propagate = False
+    listener.start()
+    return listener
+
+
+def add_log(type_of_log: str, text: str, x: config.Language, *args, postid=None):
+    """Unifies logging and makes it easier to use.
+    Lines below config.log_level are skipped before anything is formatted
+
+    Args:
+        type_of_log (string): Type of logging message (warning / info / error)
+        text (string): Logging text, may have %-style placeholders for args
+        x (Language class): Config-defined language
+        *args: Values for the placeholders, only formatted if the line is logged
+        postid (integer): Id of the post the line is about
+    """
+    level = LOG_LEVELS[type_of_log]
+    if not logger.isEnabledFor(level):
+        return
+    logger.log(level, text, *args, extra={"vk_domain": x.vk_domain, "postid": postid})
+
+    global dropped_log_lines
+    if is_bot_for_log:
+        log_message = text % args if args else text
+        if postid is not None:
+            log_message = f"[id:{postid}] {log_message}"
+        try:
+            log_queue.put_nowait((f"[{logging.getLevelName(level)}] {log_message}", x))
+        except queue.Full:
+            with dropped_log_lines_lock:
+                dropped_log_lines += 1
+
+
+if __name__ == "__main__":
+
+    log_listener = setup_logging()
+    logger.info('\n------------\n Started script \n------------\n')
+    load_group_names()
+    try:
+        file_id_cache.load()
+    except Exception as ex:
+        logger.error(f"[{type(ex).__name__}] in file_id_cache.load(): {str(ex)}")
+    prepare_temp_folder()
+    if config.trace_file:
+        tracing.configure(WORKING_DIR + "/" + config.trace_file)
+
+    log_forwarder = threading.Thread(target=forward_logs, name="log-forwarder", daemon=True)
+    if is_bot_for_log:
+        log_forwarder.start()
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="source")
+    start_pipeline()
+    if config.metrics_port:
+        metrics.start_metrics_server(config.metrics_host, config.metrics_port)
+    callback_server = None
     try:
+        callback_server = start_callback_server()
+        start_long_poll_listeners()
         if not config.single_start:
+            catch_up = True
             while True:
-                for language in config.list_of_languages:
-                    check_new_post(language)
-                add_log("i", f"Script went to sleep for {config.time_to_sleep} seconds\n\n", config.Dummy)
-                time.sleep(int(config.time_to_sleep))
+                run_cycle(executor, catch_up)
+                catch_up = False
+                time_to_sleep = get_time_to_next_poll()
+                add_log("i", "Script went to sleep for %d seconds\n\n", config.Dummy, time_to_sleep)
+                time.sleep(time_to_sleep)
         else:
-            for language in config.list_of_languages:
-                check_new_post(language)
+            run_cycle(executor, catch_up=True)
             add_log("i", "Script exited.", config.Dummy)
     except:
         add_log("e", "Something went wrong in a main loop", config.Dummy)
     finally:
+        if callback_server is not None:
+            callback_server.shutdown()
+        stop_long_poll.set()
+        executor.shutdown(wait=True)
         add_log("i", "\n------------\nScript ended\n------------\n", config.Dummy)
+        stop_log_forwarder.set()
+        if log_forwarder.is_alive():
+            log_forwarder.join()
+        log_listener.stop()
 
 
 
@@ -0,0 +1,313 @@
+import os
+import glob
+import json
+import time
+import sqlite3
+import argparse
+import threading
+from collections import OrderedDict
+
+import config
+
+
+class JsonStateStore:
+    """Keeps ids of sent posts of one language in jsons/<lang>.json
+
+    The file is loaded once, membership checks use a dict instead of scanning
+    a list, and the file is replaced atomically, so a crash while writing
+    can't leave a broken file behind. Ids are kept for every target channel,
+    ids saved before channels were tracked count as sent to all of them
+    """
+
+    def __init__(self, path, retention):
+        self.path = path
+        self.retention = retention
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.sent_ids = OrderedDict()
+        self.targets = {}
+        self.watermark = None
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                saved_state = json.load(file)
+            if isinstance(saved_state, list):  # files written before watermarks were added
+                saved_state = {"sent_ids": saved_state}
+            for post_id in saved_state.get("sent_ids", []):
+                self.sent_ids[post_id] = None
+            for target, post_ids in saved_state.get("targets", {}).items():
+                self.targets[target] = OrderedDict.fromkeys(post_ids)
+            self.watermark = saved_state.get("watermark")
+
+    def is_sent(self, post_id, target=None):
+        if post_id in self.sent_ids:
+            return True
+        if target is None:
+            return any(post_id in sent_ids for sent_ids in self.targets.values())
+        return post_id in self.targets.get(str(target), ())  # json keys are always strings
+
+    def mark_sent(self, post_id, target=None):
+        with self.lock:
+            sent_ids = self.sent_ids if target is None else self.targets.setdefault(str(target), OrderedDict())
+            sent_ids[post_id] = None
+            sent_ids.move_to_end(post_id)
+            while self.retention and len(sent_ids) > self.retention:
+                sent_ids.popitem(last=False)
+            self.dirty = True
+
+    def get_watermark(self):
+        return self.watermark
+
+    def set_watermark(self, post_id):
+        with self.lock:
+            if self.watermark is None or post_id > self.watermark:
+                self.watermark = post_id
+                self.dirty = True
+
+    def flush(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as file:
+                json.dump(
+                    {
+                        "sent_ids": list(self.sent_ids),
+                        "targets": {target: list(sent_ids) for target, sent_ids in self.targets.items()},
+                        "watermark": self.watermark,
+                    },
+                    file,
+                )
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, self.path)
+            self.dirty = False
+
+
+class SqliteStateStore:
+    """Keeps ids of sent posts of one language in a SQLite database shared by all languages
+
+    Every mark_sent() is committed right away. WAL mode and busy timeout make
+    it safe to use the same file from several bot processes. Ids sent to a
+    target channel go to sent_targets, rows of sent_posts (written before
+    channels were tracked) count as sent to all of them
+    """
+
+    def __init__(self, path, source, retention):
+        self.source = source
+        self.retention = retention
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS sent_posts ("
+                "source TEXT NOT NULL, post_id INTEGER NOT NULL, sent_at REAL NOT NULL, "
+                "PRIMARY KEY (source, post_id))"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS sent_targets ("
+                "source TEXT NOT NULL, target TEXT NOT NULL, post_id INTEGER NOT NULL, sent_at REAL NOT NULL, "
+                "PRIMARY KEY (source, target, post_id))"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS watermarks (source TEXT PRIMARY KEY, post_id INTEGER NOT NULL)"
+            )
+
+    def is_sent(self, post_id, target=None):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT 1 FROM sent_posts WHERE source = ? AND post_id = ?", (self.source, post_id)
+            ).fetchone()
+            if row is None and target is None:
+                row = self.connection.execute(
+                    "SELECT 1 FROM sent_targets WHERE source = ? AND post_id = ?", (self.source, post_id)
+                ).fetchone()
+            elif row is None:
+                row = self.connection.execute(
+                    "SELECT 1 FROM sent_targets WHERE source = ? AND target = ? AND post_id = ?",
+                    (self.source, str(target), post_id),
+                ).fetchone()
+        return row is not None
+
+    def mark_sent(self, post_id, target=None):
+        with self.lock, self.connection:
+            if target is None:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO sent_posts (source, post_id, sent_at) VALUES (?, ?, ?)",
+                    (self.source, post_id, time.time()),
+                )
+            else:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO sent_targets (source, target, post_id, sent_at) VALUES (?, ?, ?, ?)",
+                    (self.source, str(target), post_id, time.time()),
+                )
+
+    def get_watermark(self):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT post_id FROM watermarks WHERE source = ?", (self.source,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_watermark(self, post_id):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO watermarks (source, post_id) VALUES (?, ?) "
+                "ON CONFLICT(source) DO UPDATE SET post_id = MAX(post_id, excluded.post_id)",
+                (self.source, post_id),
+            )
+
+    def flush(self):
+        if not self.retention:
+            return
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM sent_posts WHERE source = ? AND post_id NOT IN ("
+                "SELECT post_id FROM sent_posts WHERE source = ? ORDER BY sent_at DESC, post_id DESC LIMIT ?)",
+                (self.source, self.source, self.retention),
+            )
+            targets = self.connection.execute(
+                "SELECT DISTINCT target FROM sent_targets WHERE source = ?", (self.source,)
+            ).fetchall()
+            for (target,) in targets:
+                self.connection.execute(
+                    "DELETE FROM sent_targets WHERE source = ? AND target = ? AND post_id NOT IN ("
+                    "SELECT post_id FROM sent_targets WHERE source = ? AND target = ? "
+                    "ORDER BY sent_at DESC, post_id DESC LIMIT ?)",
+                    (self.source, target, self.source, target, self.retention),
+                )
+
+
+class FileIdCache:
+    """Remembers Telegram file_id of every uploaded photo and document,
+    so the same media is sent by file_id instead of being uploaded again
+
+    Keys are source URLs or content hashes. At most max_entries are kept,
+    the least recently used ones are dropped first. file_id only works for
+    the bot that uploaded the file, after config.tg_bot_token is changed
+    Telegram rejects the cached ones and the media are uploaded again.
+    Reads only change the order in memory, it is saved with the next change
+    """
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.dirty = False
+        self.file_ids = OrderedDict()
+
+    def load(self):
+        if not self.max_entries or not os.path.exists(self.path):
+            return
+        with open(self.path, "r") as file:
+            saved_file_ids = json.load(file)["file_ids"]
+        with self.lock:
+            for key, file_id in saved_file_ids:  # saved from least to most recently used
+                self.file_ids[key] = file_id
+                self.file_ids.move_to_end(key)
+            while len(self.file_ids) > self.max_entries:
+                self.file_ids.popitem(last=False)
+
+    def get(self, key):
+        if key is None:
+            return None
+        with self.lock:
+            file_id = self.file_ids.get(key)
+            if file_id is not None:
+                self.file_ids.move_to_end(key)
+            return file_id
+
+    def put(self, key, file_id):
+        if not self.max_entries or key is None or not file_id:
+            return
+        with self.lock:
+            self.file_ids[key] = file_id
+            self.file_ids.move_to_end(key)
+            while len(self.file_ids) > self.max_entries:
+                self.file_ids.popitem(last=False)
+            self.dirty = True
+
+    def discard(self, key):
+        with self.lock:
+            if self.file_ids.pop(key, None) is not None:
+                self.dirty = True
+
+    def flush(self):
+        """Saves the cache if it was changed, get() and put() are not blocked while the file is written"""
+        with self.write_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                saved_file_ids = list(self.file_ids.items())
+                self.dirty = False
+            try:
+                temp_path = self.path + ".tmp"
+                with open(temp_path, "w") as file:
+                    json.dump({"file_ids": saved_file_ids}, file)
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(temp_path, self.path)
+            except Exception:
+                with self.lock:
+                    self.dirty = True
+                raise
+
+
+def open_state_store(x: config.Language):
+    """Creates the store selected by config.state_backend for the language
+
+    Args:
+        x (config.Language): Language whose sent posts are kept
+
+    Returns:
+        JsonStateStore or SqliteStateStore
+    """
+    if config.state_backend == "sqlite":
+        return SqliteStateStore(
+            config.working_dir + "/" + config.state_sqlite_file, x.name, config.sent_ids_retention
+        )
+    return JsonStateStore(config.working_dir + "/jsons/" + x.jsonfile, config.sent_ids_retention)
+
+
+def import_json_states(jsons_dir, sqlite_path):
+    """Copies sent post ids from jsons/<lang>.json files into the SQLite database
+
+    Args:
+        jsons_dir (string): Folder with <lang>.json files
+        sqlite_path (string): SQLite database file
+
+    Returns:
+        dict: language -> how many ids were imported
+    """
+    imported = {}
+    for path in sorted(glob.glob(os.path.join(jsons_dir, "*.json"))):
+        with open(path, "r") as file:
+            saved_state = json.load(file)
+        if isinstance(saved_state, list):
+            saved_state = {"sent_ids": saved_state}
+        elif "sent_ids" not in saved_state:  # not a sent ids file, e.g. group_names.json or file_ids.json
+            continue
+        source = os.path.basename(path)[: -len(".json")]
+        store = SqliteStateStore(sqlite_path, source, config.sent_ids_retention)
+        for post_id in saved_state["sent_ids"]:
+            store.mark_sent(post_id)
+        for target, post_ids in saved_state.get("targets", {}).items():
+            for post_id in post_ids:
+                store.mark_sent(post_id, target)
+        if saved_state.get("watermark") is not None:
+            store.set_watermark(saved_state["watermark"])
+        store.flush()
+        imported[source] = len(saved_state["sent_ids"]) + sum(
+            len(post_ids) for post_ids in saved_state.get("targets", {}).values()
+        )
+    return imported
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Imports jsons/<lang>.json files into the SQLite state store")
+    parser.add_argument("--jsons-dir", default=config.working_dir + "/jsons")
+    parser.add_argument("--sqlite-file", default=config.working_dir + "/" + config.state_sqlite_file)
+    args = parser.parse_args()
+    for source, count in import_json_states(args.jsons_dir, args.sqlite_file).items():
+        print(f"{source}: {count} ids imported")
@@ -0,0 +1,214 @@
+import os
+import json
+import time
+import argparse
+import threading
+from collections import defaultdict
+
+trace_file = None
+trace_file_lock = threading.Lock()
+current = threading.local()
+
+
+def configure(path):
+    """Turns tracing on, spans are appended to path as JSON lines
+
+    Args:
+        path (string): Trace file, None turns tracing off
+    """
+    global trace_file
+    with trace_file_lock:
+        if trace_file is not None:
+            trace_file.close()
+        trace_file = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            trace_file = open(path, "a", buffering=1, encoding="utf-8")
+
+
+def is_enabled():
+    return trace_file is not None
+
+
+def new_id():
+    return os.urandom(8).hex()
+
+
+def write_span(record):
+    line = json.dumps(record, ensure_ascii=False, default=str)
+    with trace_file_lock:
+        if trace_file is not None:
+            trace_file.write(line + "\n")
+
+
+def start_trace(name, **attributes):
+    """Starts the trace of one post. The returned context travels with the post
+    through the pipeline stages, see activate()
+
+    Returns:
+        dict or None if tracing is off
+    """
+    if not is_enabled():
+        return None
+    return {"trace_id": new_id(), "span_id": new_id(), "name": name, "start": time.time(), "attributes": attributes}
+
+
+def end_trace(trace, **attributes):
+    """Writes the root span of the trace, from start_trace() until now"""
+    if trace is None or not is_enabled():
+        return
+    write_span({
+        "trace_id": trace["trace_id"],
+        "span_id": trace["span_id"],
+        "parent_id": None,
+        "name": trace["name"],
+        "start": trace["start"],
+        "duration": time.time() - trace["start"],
+        "thread": threading.current_thread().name,
+        "attributes": dict(trace["attributes"], **attributes),
+    })
+
+
+class NullSpan:
+    """Used instead of Span and Activation while tracing is off, does nothing"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Activation:
+    """Makes the trace current in this thread, spans opened inside become its children"""
+
+    def __init__(self, trace):
+        self.trace = trace
+
+    def __enter__(self):
+        self.previous = getattr(current, "span", None)
+        current.span = {"trace_id": self.trace["trace_id"], "span_id": self.trace["span_id"]}
+        return self
+
+    def __exit__(self, *exc_info):
+        current.span = self.previous
+        return False
+
+
+class Span:
+    """Timed part of the current trace, written when the block ends"""
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        self.parent = current.span
+        current.span = {"trace_id": self.parent["trace_id"], "span_id": new_id()}
+        self.start = time.time()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.started
+        record = {
+            "trace_id": current.span["trace_id"],
+            "span_id": current.span["span_id"],
+            "parent_id": self.parent["span_id"],
+            "name": self.name,
+            "start": self.start,
+            "duration": duration,
+            "thread": threading.current_thread().name,
+            "attributes": self.attributes,
+        }
+        if exc_type is not None:
+            record["error"] = exc_type.__name__
+        current.span = self.parent
+        write_span(record)
+        return False
+
+
+def activate(trace):
+    """with activate(post["trace"]): ... continues the trace of the post in this thread"""
+    if trace is None or not is_enabled():
+        return NULL_SPAN
+    return Activation(trace)
+
+
+def span(name, **attributes):
+    """with span("vk.wall.get"): ... times the block as a part of the current trace.
+    Does nothing if tracing is off or no trace is active in this thread"""
+    if trace_file is None or getattr(current, "span", None) is None:
+        return NULL_SPAN
+    return Span(name, attributes)
+
+
+def read_spans(path):
+    with open(path, "r", encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def print_summary(spans, top):
+    """Prints the slowest single spans and the total time per span name"""
+    print(f"{top} slowest spans:")
+    for record in sorted(spans, key=lambda record: -record["duration"])[:top]:
+        attributes = " ".join(f"{name}={value}" for name, value in record.get("attributes", {}).items())
+        error = f" error={record['error']}" if record.get("error") else ""
+        print(f"  {record['duration']:9.3f} s  {record['name']:<32} trace={record['trace_id']} {attributes}{error}")
+
+    totals = defaultdict(lambda: {"count": 0, "total": 0, "max": 0})
+    for record in spans:
+        total = totals[record["name"]]
+        total["count"] += 1
+        total["total"] += record["duration"]
+        total["max"] = max(total["max"], record["duration"])
+    print("\nTime per span name:")
+    print(f"  {'name':<32} {'count':>7} {'total, s':>10} {'avg, s':>9} {'max, s':>9}")
+    for name, total in sorted(totals.items(), key=lambda item: -item[1]["total"]):
+        print(
+            f"  {name:<32} {total['count']:>7} {total['total']:>10.3f} "
+            f"{total['total'] / total['count']:>9.3f} {total['max']:>9.3f}"
+        )
+
+
+def export_chrome_trace(spans, path):
+    """Writes spans in Chrome trace event format (chrome://tracing, Perfetto), one row per post"""
+    rows = {}
+    events = []
+    for record in sorted(spans, key=lambda record: record["start"]):
+        if record["trace_id"] not in rows:
+            rows[record["trace_id"]] = len(rows) + 1
+        events.append({
+            "name": record["name"],
+            "ph": "X",
+            "ts": record["start"] * 1000000,
+            "dur": record["duration"] * 1000000,
+            "pid": 1,
+            "tid": rows[record["trace_id"]],
+            "args": dict(record.get("attributes", {}), thread=record["thread"], trace_id=record["trace_id"]),
+        })
+    for record in spans:
+        if record["parent_id"] is None:  # root span names the row
+            label = " ".join(f"{name}={value}" for name, value in record.get("attributes", {}).items())
+            events.append({
+                "name": "thread_name", "ph": "M", "pid": 1, "tid": rows[record["trace_id"]],
+                "args": {"name": f"{record['name']} {label}"},
+            })
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump({"traceEvents": events}, file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shows where posts spent their time, reads config.trace_file")
+    parser.add_argument("trace_file")
+    parser.add_argument("--top", type=int, default=20, help="how many slowest spans to show")
+    parser.add_argument("--chrome", metavar="FILE", help="also export the trace for chrome://tracing or Perfetto")
+    args = parser.parse_args()
+    trace_spans = read_spans(args.trace_file)
+    print_summary(trace_spans, args.top)
+    if args.chrome:
+        export_chrome_trace(trace_spans, args.chrome)
+        print(f"\nChrome trace written to {args.chrome}")